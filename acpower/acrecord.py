@@ -25,10 +25,17 @@ import time
 from subprocess import Popen, PIPE
 import datetime
 import os, sys
-import gconf
+try:
+    import gconf
+except ImportError:
+    # not needed to summarize logs copied off the XO
+    gconf = None
 import logging
 import json
 import glob
+import cStringIO
+import multiprocessing
+import olpcpwrlog
 from gettext import gettext as _
 
 VERSION = "0.2"
@@ -37,6 +44,18 @@ VERSION = "0.2"
 WORK_DIR="."
 
 DATA_FILE = os.path.expanduser("~/.acpower")
+# power events of each log kept by EventStore between runs
+EVENTS_FILE = os.path.expanduser("~/.acpower-events")
+EVENTS_VERSION = 2
+# the events output_summary works from
+POWER_EVENTS = ("ac", "startup", "shutdown")
+# the summarize_sites table, one row per site.  slot_NN is the number of
+# days the NNth 15 minute slot of the day had power.
+SITE_COLUMNS = [("site","str"), ("logs","int"), ("first_sec","float"),
+        ("last_sec","float"), ("days","float"), ("outages","int"),
+        ("mean_outage","float"), ("shortest_outage","float"),
+        ("longest_outage","float"), ("power_hours","float")] + \
+        [ ("slot_%02d" % i,"int") for i in range(96) ]
 # data_dict is global config file initialized in is_exist_data_file - used throughout
 data_dict = {}
 
@@ -324,29 +343,12 @@ class ShowPowerHistory(Tools):
             print("end date not recognized")
             sys.exit(0)
 
-    def output_summary(self, data, args):
-        # online is a dictoionary with key=start_time_stamp, value on time_seconds
-        debug = args.verbose
-        MATRIX = args.daily
-        if args.start:
-            self.set_start(args.start, args.verbose)
-        if args.end:
-            self.set_end(args.end, args.verbose)
+    def power_periods(self, data, debug=False):
+        """ (utc timestamp power came on, seconds on) of each period of power, in order """
         # online is a dictionary. key=utc_timestamp when power came on, value=seconds ontime
         online = {}
-        gap_start = None
-        if len(data) == 0:
-            print("No data for this period")
-            sys.exit(0)
-        first_ts = data[0][0]
-        first_str = self.ts2date(first_ts)
-        last_ts = data[len(data)-1][0]
-        last_str = self.ts2date(last_ts)
-        print("\n        SUMMARY OF AC POWER DURING PERIOD: %s to %s" % (first_str, last_str,))
-        print("   (Data ignored outside time period between %s and %s.)\n" % (self.ts2date(data_dict["start"]), self.ts2date(data_dict["end"]),))
-        first = data[0][0]
         power_state = None
-        power_start = first
+        power_start = data[0][0]
         for index in range(len(data)):
             if debug:
                 print(data[index][0], data[index][7],data[index][8], self.ts2str(data[index][0]))
@@ -361,35 +363,158 @@ class ShowPowerHistory(Tools):
             elif power_state and data[index][7].find('shutdown') != -1:
                 online[power_start] = data[index][0] - power_start
                 power_state = None
-        for k in sorted(online):
+        return sorted(online.items())
+
+    def outage_list(self, power_list):
+        """ (utc timestamp, length) of the outage after each power period but the last """
+        gap_length_list = []
+        for i in range(1, len(power_list)):
+            (last_key, last_on) = power_list[i-1]
+            key = power_list[i][0]
+            gap_length_list.append( (last_key + last_on,key - (last_key + last_on)) )
+        return gap_length_list
+
+    def mean_outage(self, gap_list):
+        """ average length in seconds of the outages in gap_list """
+        return sum([ length for (start, length) in gap_list ]) / float(len(gap_list))
+
+    def power_buckets(self, power_list, first_ts, last_ts, matrix=False, debug=False, tzinfo=tz):
+        """
+        The number of days each 15 minute slot of the day had power, days
+        starting at midnight in tzinfo.  With matrix the slots are also
+        printed, one line per day.
+        """
+        #divide up the total time into 15 minute chunks and distribute
+        #    X's across the 96 columns of a day for each chunk that has power
+
+        # first get the offset of the first entry from midnight
+        firstdt = datetime.datetime.fromtimestamp(first_ts, tzinfo)
+        first_midnight_local = firstdt - datetime.timedelta(\
+                hours=firstdt.hour,minutes=firstdt.minute, seconds=firstdt.second)
+        # lets do all the time in seconds since 1970 (tstamp) and in UTC
+        midnight_str = self.format_datetime(first_midnight_local)
+        if debug:
+            print("midnight should be:%s"%midnight_str)
+        first_midnight_seconds = self.tstamp(first_midnight_local)
+        last_seconds = last_ts
+        current_bucket_seconds = first_midnight_seconds
+        current_power_state = False  # we backtracked from the time when the monitor was enabled
+        power_on_seconds = first_ts
+        power_off_seconds = power_on_seconds + power_list[0][1] 
+        seconds_in_day = 24.0 * 60 * 60
+        seconds_in_current_day = 1000
+        bucket_size = 60 * 15.0
+
+        if debug:
+            for k,v in power_list:
+                print("key:%s, string:%s, value:%s"%(k,self.ts2str(k), v,))
+            print("Before loop begins: on:%s, off:%s,bucket_seconds:%s"%(\
+            self.ts2str(power_on_seconds),self.ts2str(power_off_seconds),\
+            self.ts2str(current_bucket_seconds),))
+        buckets = []
+        for j in range(96):
+            buckets.append(0)
+        if matrix:
+            current_day_ts = first_ts
+            current_day_str = self.ts2date(current_day_ts)
+            print("One line per day. Current day: %s"%current_day_str)
+        # Sweep the buckets and the sorted power periods together.  The
+        # state of a bucket comes from the last period that started at
+        # or before it, so the period index only ever moves forward.
+        period_index = -1
+        while current_bucket_seconds < last_seconds:
+            while period_index + 1 < len(power_list) and \
+                    power_list[period_index + 1][0] <= current_bucket_seconds:
+                period_index += 1
+            if period_index >= 0:
+                current_power_state = power_list[period_index][0] + \
+                    power_list[period_index][1] > current_bucket_seconds
+            if matrix:
+                if current_power_state:
+                    sys.stdout.write("X")
+                else:
+                    sys.stdout.write(" ")
+            bucket_index = int(seconds_in_current_day / bucket_size)
+            if current_power_state:
+                buckets[bucket_index] += 1
+
+            current_bucket_seconds += bucket_size
+            seconds_in_current_day = (current_bucket_seconds - first_midnight_seconds) % seconds_in_day
+            if seconds_in_current_day < 10 and matrix:
+                print
+        return buckets
+
+    def power_stats(self, data, tzinfo=tz):
+        """
+        The figures output_summary reports for data, as a dict keyed on
+        the SITE_COLUMNS names.  Times are in seconds.
+        """
+        stats = {"first_sec":0.0, "last_sec":0.0, "days":0.0, "outages":0,
+                "mean_outage":0.0, "shortest_outage":0.0, "longest_outage":0.0,
+                "power_hours":0.0}
+        buckets = [0] * 96
+        if len(data) > 0:
+            first_ts = data[0][0]
+            last_ts = data[len(data)-1][0]
+            total_seconds = last_ts - first_ts
+            power_list = self.power_periods(data)
+            mysum = sum([ value for (key, value) in power_list ])
+            stats.update(first_sec=first_ts, last_sec=last_ts,
+                    days=total_seconds / 86400.0)
+            if len(power_list) > 1:
+                gap_list = sorted(self.outage_list(power_list), key=lambda x:x[1])
+                stats.update(outages=len(gap_list),
+                        mean_outage=self.mean_outage(gap_list),
+                        shortest_outage=gap_list[0][1],
+                        longest_outage=gap_list[len(gap_list)-1][1])
+                # outages never overlap, so this only fails on a bad gap sum
+                assert stats["shortest_outage"] <= stats["mean_outage"] <= \
+                    stats["longest_outage"]
+            if total_seconds > 0:
+                stats["power_hours"] = (float(mysum)/total_seconds) * 24
+            if len(power_list) > 0:
+                buckets = self.power_buckets(power_list, first_ts, last_ts, tzinfo=tzinfo)
+        for i in range(96):
+            stats["slot_%02d" % i] = buckets[i]
+        return stats
+
+    def output_summary(self, data, args):
+        debug = args.verbose
+        MATRIX = args.daily
+        if args.start:
+            self.set_start(args.start, args.verbose)
+        if args.end:
+            self.set_end(args.end, args.verbose)
+        if len(data) == 0:
+            print("No data for this period")
+            sys.exit(0)
+        first_ts = data[0][0]
+        first_str = self.ts2date(first_ts)
+        last_ts = data[len(data)-1][0]
+        last_str = self.ts2date(last_ts)
+        print("\n        SUMMARY OF AC POWER DURING PERIOD: %s to %s" % (first_str, last_str,))
+        print("   (Data ignored outside time period between %s and %s.)\n" % (self.ts2date(data_dict["start"]), self.ts2date(data_dict["end"]),))
+        power_list = self.power_periods(data, debug)
+        for k, v in power_list:
             if debug:
-                print(self.ts2str(k), "minutes:",(online[k])/60)
+                print(self.ts2str(k), "minutes:",(v)/60)
         total_seconds = last_ts - first_ts
         (days, hours, minutes) = self.dhm_from_seconds(total_seconds)
         print "length of log %s days, %s hours, %s minutes" % (days, hours, minutes)
-        number_of_gaps = len(online) - 1
+        number_of_gaps = len(power_list) - 1
         print "number of power outages: %s" % number_of_gaps
         # mysum is total power online seconds
         mysum = 0L
-        power_list = []
-        gap_length_list = []
-        first = False
-        if len(online) > 1:
-            for key in sorted(online):
-                mysum += online[key]
-                power_list.append( (key,online[key]) )
-                if first:
-                    gap_length_list.append( (last_key + online[last_key],key -last_key + online[last_key]) )
-                first = True
-                last_key = key
+        if len(power_list) > 1:
+            for key, value in power_list:
+                mysum += value
+            gap_length_list = self.outage_list(power_list)
             # compute the average length of outage
-            average_seconds = (total_seconds - mysum) / float(number_of_gaps)
+            average_seconds = self.mean_outage(gap_length_list)
             (days, hours, minutes) = self.dhm_from_seconds(average_seconds)
             print "average length of outage: %s days %s hours %s minutes" % \
                 (days, hours,minutes)
             gap_list = sorted(gap_length_list, key=lambda x:x[1])
-            ts_list = sorted(power_list)
-            last_seconds = power_list[len(power_list)-1][0] + power_list[len(power_list)-1][1]
             if debug:
                 print("power_list - utc_start, power on seconds")
                 for item, value in power_list:
@@ -413,66 +538,7 @@ class ShowPowerHistory(Tools):
             print("Average power within 24 hours:%2.2f hours"%average_per_day)
 
             print "\n\nDISTRUBUTION OF POWER OVER THE DAY"
-            buckets = []
-
-            #divide up the total time into 15 minute chunks and distribute
-            #    X's across the 96 columns of a day for each chunk that has power
-
-           # first get the offset of the first entry from midnight
-            firstdt = datetime.datetime.fromtimestamp(first_ts, tz)
-            first_midnight_local = firstdt - datetime.timedelta(\
-                    hours=firstdt.hour,minutes=firstdt.minute, seconds=firstdt.second)
-            # lets do all the time in seconds since 1970 (tstamp) and in UTC
-            midnight_str = self.format_datetime(first_midnight_local)
-            if debug:
-                print("midnight should be:%s"%midnight_str)
-            first_midnight_seconds = self.tstamp(first_midnight_local)
-            last_seconds = last_ts
-            current_bucket_seconds = first_midnight_seconds
-            current_power_state = False  # we backtracked from the time when the monitor was enabled
-            key_index = 0
-            power_on_seconds = first_ts
-            power_off_seconds = power_on_seconds + power_list[0][1] 
-            seconds_in_day = 24.0 * 60 * 60
-            seconds_in_current_day = 1000
-            bucket_size = 60 * 15.0
-            
-            if debug:
-                for k,v in ts_list:
-                    print("key:%s, string:%s, value:%s"%(k,self.ts2str(k), v,))
-                print("Before loop begins: on:%s, off:%s,bucket_seconds:%s"%(\
-                self.ts2str(power_on_seconds),self.ts2str(power_off_seconds),\
-                self.ts2str(current_bucket_seconds),))
-            buckets = []
-            for j in range(96):
-                buckets.append(0)
-            if MATRIX:
-                current_day_ts = first_ts
-                current_day_str = self.ts2date(current_day_ts)
-                print("One line per day. Current day: %s"%current_day_str)
-            while current_bucket_seconds < last_seconds:
-                for index in range(len(ts_list)):
-                    if ts_list[index][0] > current_bucket_seconds:
-                        break
-                    if ts_list[index][0] + ts_list[index][1] > current_bucket_seconds: 
-                        current_power_state = True
-                    else:
-                        current_power_state = False
-                if MATRIX:
-                    if current_power_state:
-                        sys.stdout.write("X")
-                    else:
-                        sys.stdout.write(" ")
-                if GRAPH:
-                    bucket_index = int(seconds_in_current_day / bucket_size)
-                    if current_power_state:
-                        buckets[bucket_index] += 1
-
-
-                current_bucket_seconds += bucket_size
-                seconds_in_current_day = (current_bucket_seconds - first_midnight_seconds) % seconds_in_day
-                if seconds_in_current_day < 10 and MATRIX:
-                    print
+            buckets = self.power_buckets(power_list, first_ts, last_ts, MATRIX, debug)
             if GRAPH:
 # find the max of the buckets
                 print("\nBar Graph")
@@ -505,6 +571,186 @@ class ShowPowerHistory(Tools):
         print("")
         print("AC Power Monitor is currently %s"%state)
 
+class EventStore(Tools):
+    """
+    The power events of every log, kept in EVENTS_FILE between runs.  A
+    log that has not changed is not read again and a plain text log that
+    has grown only has its new lines parsed.  Logs are identified by
+    path and inode, so a replaced or truncated log is read from scratch.
+    """
+    def __init__(self, rescan=False):
+        self.files = {}
+        self.seen = set()
+        if rescan:
+            return
+        try:
+            fd = file(EVENTS_FILE,'r')
+            state = json.loads(fd.read())
+            fd.close()
+        except (IOError, ValueError):
+            return
+        if state.get("version") != EVENTS_VERSION:
+            return
+        for (fname, entry) in state["files"].iteritems():
+            # json gives the strings back as unicode
+            for key in ("events", "partial"):
+                entry[key] = [ row[:6] + [ str(x) for x in row[6:] ] \
+                        for row in entry[key] ]
+            self.files[str(fname)] = entry
+
+    def file_events(self, pl, fname):
+        """
+        The converted records of fname's power events, in file order,
+        and a list of bad lines.  A log with bad lines is not stored, so
+        it is reported again next time just as a full parse would.  The
+        events of a last line without its newline are kept apart in
+        "partial" and replaced when the log grows.
+        """
+        self.seen.add(fname)
+        st = os.stat(fname)
+        entry = self.files.get(fname)
+        if entry and entry["ino"] == st.st_ino:
+            if entry["size"] == st.st_size:
+                return (entry["events"] + entry["partial"], [])
+            if entry["offset"] is not None and st.st_size > entry["size"]:
+                pl.parse_header(fname)
+                (records, errors, offset, line_num, partial) = pl.tail_records(
+                        entry["offset"], entry["line_num"], POWER_EVENTS)
+                if len(errors):
+                    del self.files[fname]
+                    return (records + partial, errors)
+                entry["events"].extend(records)
+                entry.update(size=st.st_size, offset=offset, line_num=line_num,
+                        partial=partial)
+                return (entry["events"] + partial, [])
+
+        if fname in self.files:
+            del self.files[fname]
+        pl.parse_header(fname)
+        header = olpcpwrlog.scan_header(fname)
+        partial = []
+        if header["binlog"]:
+            (records, errors) = pl.binlog_events(POWER_EVENTS)
+            offset = line_num = None
+        else:
+            (records, errors, offset, line_num, partial) = pl.tail_records(
+                    header["offset"], len(header["lines"]), POWER_EVENTS)
+        if olpcpwrlog.log_compression(fname):
+            # Only plain text logs are appended to
+            records = records + partial
+            partial = []
+            offset = line_num = None
+        if len(errors) == 0:
+            self.files[fname] = {"ino":st.st_ino, "size":st.st_size,
+                    "offset":offset, "line_num":line_num, "events":records,
+                    "partial":partial}
+        return (records + partial, errors)
+
+    def read_logs(self, pl, filenames, verbose=False):
+        """ power events of each of filenames that parsed, keyed by filename """
+        events = {}
+        numfiles = len(filenames)
+        filenum = 0
+        for fname in filenames:
+            filenum+=1
+            if verbose:
+                print "%d of %d\r" % (filenum,numfiles),
+            sys.stdout.flush()
+            try:
+                (records, errors) = self.file_events(pl, fname)
+            except:
+                print "%s : Could not parse header. Error: " % fname,
+                print sys.exc_info()
+                continue
+
+            # A file with a bad line is dropped whole
+            if len(errors):
+                print "%s : Skipping.  Line errors: " % fname
+                for e in errors:
+                    print e
+                continue
+            events[fname] = records
+        return events
+
+    def save(self):
+        """ writes the events of the logs seen this run """
+        state = {"version":EVENTS_VERSION, "files":dict([ (f, self.files[f]) \
+                for f in self.seen if f in self.files ])}
+        tmpname = "%s.%d.tmp" % (EVENTS_FILE, os.getpid())
+        try:
+            fd = file(tmpname,'w')
+            fd.write(json.dumps(state))
+            fd.close()
+            os.rename(tmpname, EVENTS_FILE)
+        except (IOError, OSError),e:
+            logging.exception("failed to write events file. error:%s"% (e,))
+
+def select_values(events, start, end):
+    """ the events between start and end as output_summary takes them """
+    selected_values = []
+    for fname in sorted(events):
+        file_values = []
+        for sval in events[fname]:
+            if sval[0] < start or sval[0] > end:
+                continue
+            values = []
+            values.append(int(sval[0]))
+            values.append(int(sval[1]))
+            values.extend(sval[2:])
+            file_values.append((sval[0], values))
+
+        file_values.sort(key=lambda x:x[0])
+        selected_values.extend([values for (sec, values) in file_values])
+    selected_values.sort(key=lambda x:x[0])
+    return selected_values
+
+def site_summary(job):
+    """
+    Pool worker: the power_stats of one site's logs.  job is (site,
+    dataroot,start,end).  Returns (stats,output) where output is whatever
+    reading the logs printed, so the parent can show it in site order.
+    """
+    (site, dataroot, start, end) = job
+    stdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()
+    try:
+        pl = olpcpwrlog.PwrLogfile()
+        filenames = []
+        for root, subdirs, names in os.walk(dataroot):
+            filenames.extend([ os.path.join(root,name) for name in names \
+                    if name != olpcpwrlog.INDEX_NAME ])
+        filenames.sort()
+        # Nothing is saved, so the sites never see each other's events
+        events = EventStore(rescan=True).read_logs(pl, filenames)
+        data = select_values(events, start, end)
+        # Days start at midnight where the logs were made, taken from
+        # the last log read
+        stats = ShowPowerHistory().power_stats(data, pl.local_tz)
+        output = sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+    stats["site"] = site
+    stats["logs"] = len(events)
+    return (stats, output)
+
+def summarize_sites(sites, start=0, end=sys.maxint, jobs=1):
+    """
+    Generate site_summary's (stats,output) for each of sites, a list of
+    (site name,power-logs directory), in order, using jobs processes.
+    Only events between start and end are counted.
+    """
+    site_jobs = [ (site, dataroot, start, end) for (site, dataroot) in sites ]
+    if jobs <= 1:
+        for job in site_jobs:
+            yield site_summary(job)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    for result in pool.imap(site_summary, site_jobs):
+        yield result
+    pool.close()
+    pool.join()
+
 class RawData(Tools):
     def __init__(self):
         global data_dict
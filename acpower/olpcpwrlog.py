@@ -8,11 +8,1264 @@
 import sys
 import csv
 import os
+import io
+import gzip
+import re
 import traceback
 import argparse
-from datetime import datetime, date, time
+import bisect
+import hashlib
+import cPickle
+import json
+import struct
+import cStringIO
+import multiprocessing
+from datetime import datetime, date, time, timedelta
 from dateutil import tz, parser
 
+SECS_PER_DAY = 86400
+
+def utc_offset(local_tz,sec):
+	"""UTC offset in whole seconds of local_tz at UNIX time sec"""
+	offset = datetime.fromtimestamp(sec,tz.tzutc()).astimezone(local_tz).utcoffset()
+	if offset is None:
+		return 0
+	return offset.days * SECS_PER_DAY + offset.seconds
+
+def utc_offset_intervals(local_tz,start,end):
+	"""
+	Split the time span start..end into runs of constant UTC offset.
+	Returns a list of (first_sec,offset) tuples.  Fixed offset zones,
+	which is what the `date -R` DATE header gives us, cost nothing.
+	Anything else is probed once a day and the DST changes are found
+	to the second by bisection.
+	"""
+	start = int(start // 1)
+	if isinstance(local_tz,(tz.tzutc,tz.tzoffset)):
+		return [(start,utc_offset(local_tz,start))]
+
+	current = utc_offset(local_tz,start)
+	intervals = [(start,current)]
+	sec = start
+	while sec < end:
+		next_sec = min(sec + SECS_PER_DAY,int(-(-end // 1)))
+		offset = utc_offset(local_tz,next_sec)
+		if offset != current:
+			low,high = sec,next_sec
+			while high - low > 1:
+				mid = (low + high) // 2
+				if utc_offset(local_tz,mid) == current:
+					low = mid
+				else:
+					high = mid
+			intervals.append((high,offset))
+			current = offset
+		sec = next_sec
+	return intervals
+
+class LocalClock:
+	"""
+	Time of day and date strings for sample timestamps without building
+	a datetime for every sample.  The UTC offset is looked up once per
+	DST interval of local_tz and the rest is integer math.
+	"""
+	def __init__(self,local_tz):
+		self.local_tz = local_tz
+		self.starts = []
+		self.offsets = []
+		self.end = None
+		self.day_strings = {}
+
+	def cover(self,start,end):
+		"""Make sure the offsets for start..end are known"""
+		if self.end is not None and start >= self.starts[0] and end <= self.end:
+			return
+		if self.end is not None:
+			start = min(start,self.starts[0])
+			end = max(end,self.end)
+		# A day of headroom so a log read one row at a time only
+		# extends the table once a day.
+		end += SECS_PER_DAY
+		intervals = utc_offset_intervals(self.local_tz,start,end)
+		self.starts = [x[0] for x in intervals]
+		self.offsets = [x[1] for x in intervals]
+		self.end = end
+
+	def utc_offset(self,sec):
+		self.cover(sec,sec)
+		return self.offsets[bisect.bisect_right(self.starts,sec) - 1]
+
+	def time_of_day(self,sec):
+		"""Local time of day as hours + minutes/60"""
+		local = sec + self.utc_offset(sec)
+		return float(int(local // 3600 % 24)) + float(int(local // 60 % 60))/60.0
+
+	def utc_date_string(self,sec):
+		"""UTC time as YYYY-mm-dd HH:MM:SS"""
+		sec = int(sec // 1)
+		day,rem = divmod(sec,SECS_PER_DAY)
+		try:
+			day_str = self.day_strings[day]
+		except KeyError:
+			day_str = (datetime(1970,1,1) + timedelta(days=day)).strftime("%Y-%m-%d")
+			self.day_strings[day] = day_str
+		return "%s %02d:%02d:%02d" % (day_str,rem // 3600,rem // 60 % 60,rem % 60)
+
+CACHE_DIR = os.path.expanduser('~/.cache/olpc-pwrlogs')
+# Megabytes
+CACHE_SIZE = 256
+# Bump this when the parsers change what they produce
+CACHE_VERSION = 1
+
+class ParseCache:
+	"""
+	On disk cache of parsed log files.  Entries are keyed on the log's
+	path, size and mtime plus whatever parse parameters the caller hands
+	in, so an edited or replaced log is simply a miss.  Each entry is one
+	pickle (protocol 2 stores numpy arrays as raw buffers).  When the
+	cache grows past max_size MB the least recently used entries go.
+	"""
+	def __init__(self,cache_dir=CACHE_DIR,max_size=CACHE_SIZE):
+		self.cache_dir = cache_dir
+		self.max_bytes = max_size * 1024 * 1024
+		self.total_bytes = None
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	def entry_name(self,filename,params):
+		st = os.stat(filename)
+		key = repr((CACHE_VERSION,os.path.abspath(filename),st.st_size,st.st_mtime,sorted(params.items())))
+		return os.path.join(self.cache_dir,hashlib.sha1(key).hexdigest() + '.pkl')
+
+	def load(self,filename,params):
+		"""Return what was stored for this file and params or None"""
+		try:
+			name = self.entry_name(filename,params)
+			fd = open(name,'rb')
+		except (OSError,IOError):
+			return None
+		try:
+			try:
+				value = cPickle.load(fd)
+			finally:
+				fd.close()
+		except:
+			# Truncated or from an incompatible version.  Drop it.
+			self.remove(name)
+			return None
+		# Mark it as recently used
+		try:
+			os.utime(name,None)
+		except OSError:
+			pass
+		return value
+
+	def store(self,filename,params,value):
+		try:
+			name = self.entry_name(filename,params)
+			tmpname = '%s.%d.tmp' % (name,os.getpid())
+			fd = open(tmpname,'wb')
+			try:
+				cPickle.dump(value,fd,2)
+			finally:
+				fd.close()
+			os.rename(tmpname,name)
+		except (OSError,IOError):
+			print 'Could not write cache entry for %s' % filename
+			return
+		if self.total_bytes is not None:
+			self.total_bytes += os.path.getsize(name)
+		if self.total_bytes is None or self.total_bytes > self.max_bytes:
+			self.evict()
+
+	def remove(self,name):
+		try:
+			os.remove(name)
+		except OSError:
+			pass
+
+	def evict(self):
+		"""Drop the oldest entries until we are back under 90% of the limit"""
+		entries = []
+		for name in os.listdir(self.cache_dir):
+			path = os.path.join(self.cache_dir,name)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			entries.append((st.st_mtime,st.st_size,path))
+		entries.sort()
+		self.total_bytes = sum([x[1] for x in entries])
+		if self.total_bytes <= self.max_bytes:
+			return
+		target = self.max_bytes * 9 / 10
+		for (mtime,size,path) in entries:
+			if self.total_bytes <= target:
+				break
+			self.remove(path)
+			self.total_bytes -= size
+
+	def clear(self):
+		for name in os.listdir(self.cache_dir):
+			self.remove(os.path.join(self.cache_dir,name))
+		self.total_bytes = 0
+
+# Logs may be stored compressed.  gzip is always available, xz and zstd
+# only when their modules are installed.
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# (magic bytes, format) of the compressed formats open_log understands
+COMPRESSED_MAGIC = [('\x1f\x8b','gzip'),('\xfd7zXZ\x00','xz'),('\x28\xb5\x2f\xfd','zstd')]
+# Buffer for decompressed data.  Keeps readline in C.
+DECOMPRESS_BUFFER = 65536
+
+def log_compression(filename):
+	"""The compression format of filename from its magic bytes, or None"""
+	fd = open(filename,'rb')
+	try:
+		magic = fd.read(6)
+	finally:
+		fd.close()
+	for (prefix,kind) in COMPRESSED_MAGIC:
+		if magic.startswith(prefix):
+			return kind
+	return None
+
+def open_log(filename,offset=0):
+	"""
+	Open a log for reading, decompressing gzip, xz and zstd logs as they
+	are read.  The format comes from the magic bytes, not the name.
+	offset is where to start in the uncompressed data.  Raises IOError
+	for a format whose module is not installed.
+	"""
+	kind = log_compression(filename)
+	if kind is None:
+		fd = open(filename,'rb')
+		if offset:
+			fd.seek(offset)
+		return fd
+
+	if kind == 'gzip':
+		raw = gzip.GzipFile(filename,'rb')
+	elif kind == 'xz':
+		if lzma is None:
+			raise IOError('%s is xz compressed and no lzma module is installed' % filename)
+		raw = lzma.LZMAFile(filename,'rb')
+	else:
+		if zstandard is None:
+			raise IOError('%s is zstd compressed and the zstandard module is not installed' % filename)
+		raw = zstandard.ZstdDecompressor().stream_reader(open(filename,'rb'))
+	fd = io.BufferedReader(raw,DECOMPRESS_BUFFER)
+	# Not every decompressor can seek, so skip ahead by reading
+	while offset > 0:
+		skipped = len(fd.read(min(offset,DECOMPRESS_BUFFER)))
+		if skipped == 0:
+			break
+		offset -= skipped
+	return fd
+
+# Binary logs.  A fixed prefix, a JSON block with the text header lines,
+# the record columns and the status/event string table, then packed
+# little endian records starting on an 8 byte boundary.  The record
+# layout follows the columns the text log had.
+BINLOG_MAGIC = 'OLPCPWRB'
+BINLOG_VERSION = 1
+BINLOG_EXT = '.pwrb'
+# magic, version, length of the JSON block, number of records
+BINLOG_PREFIX = struct.Struct('<8sIIQ')
+# Column order of the text logs written by log_reading and by powerd
+PWRLOG_COLUMNS = ['sec','soc','voltage','current','temp','acr','status',
+	'mah_net','minutes','vin','w_sample']
+POWERD_COLUMNS = ['sec','soc','voltage','current','temp','acr','status','event']
+# struct/numpy type of each column.  Strings are stored as an index into
+# the string table.
+BINLOG_TYPES = {'sec':'I','soc':'h','voltage':'i','current':'i','temp':'h',
+	'acr':'i','status':'B','event':'B','mah_net':'i','minutes':'i',
+	'vin':'i','w_sample':'i'}
+BINLOG_STRINGS = ('status','event')
+
+def is_binlog(filename):
+	"""True if filename is a binary log, compressed or not"""
+	fd = open_log(filename)
+	try:
+		return fd.read(len(BINLOG_MAGIC)) == BINLOG_MAGIC
+	finally:
+		fd.close()
+
+def read_binlog_info(fd):
+	"""
+	Read the prefix and JSON block of the binary log open on fd, leaving
+	fd at the first record.  Returns a dict with the header lines,
+	columns, strings, record count and the offset of the first record.
+	"""
+	(magic,version,meta_len,count) = BINLOG_PREFIX.unpack(fd.read(BINLOG_PREFIX.size))
+	if magic != BINLOG_MAGIC:
+		raise ValueError('not a binary power log')
+	if version != BINLOG_VERSION:
+		raise ValueError('unknown binary power log version %d' % version)
+	meta = json.loads(fd.read(meta_len))
+	info = {}
+	# The text was decoded byte for byte on the way in
+	info['lines'] = [ line.encode('latin-1') for line in meta['header'] ]
+	info['columns'] = [ str(c) for c in meta['columns'] ]
+	info['strings'] = [ s.encode('latin-1') for s in meta['strings'] ]
+	info['count'] = count
+	info['offset'] = (BINLOG_PREFIX.size + meta_len + 7) & ~7
+	# Read over the padding rather than seek; fd may be decompressing
+	fd.read(info['offset'] - BINLOG_PREFIX.size - meta_len)
+	return info
+
+def binlog_struct(columns):
+	return struct.Struct('<' + ''.join([ BINLOG_TYPES[c] for c in columns ]))
+
+def write_binlog(csvname,binname):
+	"""
+	Convert the text log csvname to a binary log.  Raises ValueError,
+	naming the line, if a data row does not fit the record layout, so a
+	converted log always holds everything the text one did.
+	"""
+	fd = open_log(csvname)
+	try:
+		header = []
+		while True:
+			line = fd.readline()
+			if not line:
+				break
+			header.append(line)
+			if line.rstrip('\r\n').split(',')[0] == '<StartData>':
+				break
+
+		if header and header[0].startswith('powerd_log_ver:'):
+			layout = POWERD_COLUMNS
+		else:
+			layout = PWRLOG_COLUMNS
+		columns = []
+		record = None
+		strings = []
+		codes = {}
+		records = []
+		reader = csv.reader(fd)
+		for row in reader:
+			if not row:
+				continue
+			line_num = len(header) + reader.line_num
+			if record is None:
+				if len(row) > len(layout):
+					raise ValueError('%s line %d: %d fields, at most %d known' %
+						(csvname,line_num,len(row),len(layout)))
+				columns = layout[:len(row)]
+				record = binlog_struct(columns)
+			if len(row) != len(columns):
+				raise ValueError('%s line %d: %d fields, expected %d' %
+					(csvname,line_num,len(row),len(columns)))
+			values = []
+			try:
+				for (column,value) in zip(columns,row):
+					if column in BINLOG_STRINGS:
+						if value not in codes:
+							codes[value] = len(strings)
+							strings.append(value)
+						values.append(codes[value])
+					else:
+						values.append(int(value))
+				records.append(record.pack(*values))
+			except (ValueError,struct.error):
+				raise ValueError('%s line %d: %s does not fit the record layout' %
+					(csvname,line_num,','.join(row)))
+	finally:
+		fd.close()
+
+	meta = json.dumps({'header':[ line.decode('latin-1') for line in header ],
+		'columns':columns,'strings':[ s.decode('latin-1') for s in strings ]})
+	prefix = BINLOG_PREFIX.pack(BINLOG_MAGIC,BINLOG_VERSION,len(meta),len(records))
+	pad = -(len(prefix) + len(meta)) % 8
+	out = open(binname,'wb')
+	try:
+		out.write(prefix + meta + '\0' * pad)
+		out.write(''.join(records))
+	finally:
+		out.close()
+
+def load_binlog(filename):
+	"""
+	Map the records of a binary log as a NumPy structured array, without
+	copying them.  A compressed binary log is decompressed into memory
+	instead.  Returns (info,records) with info as read_binlog_info gives
+	it.  Needs numpy, which the rest of this module does not.
+	"""
+	import numpy
+	fd = open_log(filename)
+	try:
+		info = read_binlog_info(fd)
+		dtype = numpy.dtype([ (c,'<' + BINLOG_TYPES[c]) for c in info['columns'] ])
+		if info['count'] == 0:
+			return (info,numpy.zeros(0,dtype=dtype))
+		if log_compression(filename):
+			data = fd.read(info['count'] * dtype.itemsize)
+			return (info,numpy.frombuffer(data,dtype=dtype,count=info['count']))
+	finally:
+		fd.close()
+	records = numpy.memmap(filename,dtype=dtype,mode='r',offset=info['offset'],
+		shape=(info['count'],))
+	return (info,records)
+
+class BinlogReader:
+	"""
+	The rows of a binary log the way csv.reader gives them for the text
+	log: the header rows and then one list per record, with line_num
+	counting lines the same way.  Numeric fields come back as ints
+	rather than strings; the readers only ever pass them to int() or
+	float().  With skip_header it starts at the first record, as a
+	csv.reader on a file seeked past <StartData>.
+	"""
+	# Records read per chunk
+	chunk = 4096
+
+	def __init__(self,filename,skip_header=False):
+		self.fd = open_log(filename)
+		self.info = read_binlog_info(self.fd)
+		self.line_num = 0
+		self.rows = self.generate_rows(skip_header)
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		return self.rows.next()
+
+	def generate_rows(self,skip_header):
+		info = self.info
+		if skip_header:
+			self.line_num = len(info['lines'])
+		else:
+			for row in csv.reader(info['lines']):
+				self.line_num += 1
+				yield row
+
+		columns = info['columns']
+		width = len(columns)
+		record = binlog_struct(columns)
+		strings = info['strings']
+		string_cols = [ i for (i,c) in enumerate(columns) if c in BINLOG_STRINGS ]
+		left = info['count']
+		while left > 0:
+			n = min(left,self.chunk)
+			block = self.fd.read(n * record.size)
+			n = len(block) // record.size
+			if n == 0:
+				break
+			# One unpack for the whole chunk
+			values = list(struct.unpack('<' + record.format[1:] * n,block[:n * record.size]))
+			for i in string_cols:
+				values[i::width] = [ strings[int(v)] for v in values[i::width] ]
+			for start in xrange(0,n * width,width):
+				self.line_num += 1
+				yield values[start:start + width]
+			left -= n
+		self.fd.close()
+
+def log_reader(filename):
+	"""
+	csv.reader over a text log, or the same rows from a binary log.
+	Either may be compressed.
+	"""
+	if is_binlog(filename):
+		return BinlogReader(filename)
+	return csv.reader(open_log(filename))
+
+INDEX_NAME = '.pwrlog-index'
+
+def scan_header(filename):
+	"""
+	Read just the header of a log.  Returns an index entry: the raw
+	header lines up to and including <StartData>, the KEY: value fields
+	the way the readers split them, the byte offset of the data (in the
+	uncompressed log) and whether it is a binary log.
+	"""
+	st = os.stat(filename)
+	lines = []
+	binlog = is_binlog(filename)
+	fd = open_log(filename)
+	try:
+		if binlog:
+			# The header lines are kept as they were in the text log
+			info = read_binlog_info(fd)
+			lines = info['lines']
+			offset = info['offset']
+		else:
+			offset = 0
+			while True:
+				line = fd.readline()
+				if not line:
+					break
+				lines.append(line)
+				offset += len(line)
+				if line.rstrip('\r\n').split(',')[0] == '<StartData>':
+					break
+	finally:
+		fd.close()
+
+	# Same defaults the readers use for old header formats
+	fields = {'XOVER':'1','KERNAPI':'0'}
+	for line in lines:
+		first = line.rstrip('\r\n').split(',')[0]
+		if first == '<StartData>':
+			break
+		values = first.split(':')
+		if not first or values[0] == 'DATE':
+			continue
+		if len(values) > 1:
+			fields[values[0]] = values[1].strip()
+		else:
+			fields[values[0]] = ''
+	return {'size':st.st_size,'mtime':st.st_mtime,'offset':offset,
+		'lines':lines,'fields':fields,'binlog':binlog}
+
+# The DATE: header as `date -R` writes it, after the csv reader has split
+# it at the comma and the fields have been run back together
+RFC2822_DATE = re.compile(r'\s*(?:[A-Za-z]{3},?\s+)?(\d{1,2})\s+([A-Za-z]{3})\s+(\d{4})'
+	r'\s+(\d{1,2}):(\d\d)(?::(\d\d))?\s+([+-])(\d\d)(\d\d)\s*$')
+MONTHS = dict([ (m,n+1) for (n,m) in enumerate(['jan','feb','mar','apr','may','jun',
+	'jul','aug','sep','oct','nov','dec']) ])
+
+# Memo of parse_header_date results.  Logs from one run of a machine
+# often share a DATE line.
+header_dates = {}
+HEADER_DATES_SIZE = 10000
+
+def parse_header_date(dstring):
+	"""
+	The timezone aware datetime of a DATE: header string, as
+	dateutil's fuzzy parse would give it.  The `date -R` format is
+	parsed directly and anything else goes to dateutil.
+	"""
+	try:
+		return header_dates[dstring]
+	except KeyError:
+		pass
+	rundate = None
+	match = RFC2822_DATE.match(dstring)
+	if match and int(match.group(9)) < 60:
+		(day,month,year,hour,minute,second,sign,tzh,tzm) = match.groups()
+		offset = int(tzh) * 3600 + int(tzm) * 60
+		if sign == '-':
+			offset = -offset
+		if offset == 0:
+			tzinfo = tz.tzutc()
+		else:
+			tzinfo = tz.tzoffset(None,offset)
+		try:
+			rundate = datetime(int(year),MONTHS[month.lower()],int(day),
+				int(hour),int(minute),int(second or 0),tzinfo=tzinfo)
+		except (KeyError,ValueError):
+			rundate = None
+	if rundate is None:
+		rundate = parser.parse(dstring,fuzzy=True)
+	if len(header_dates) >= HEADER_DATES_SIZE:
+		header_dates.clear()
+	header_dates[dstring] = rundate
+	return rundate
+
+def header_date_string(lines):
+	"""
+	The date_string parse_header would give for these raw header lines:
+	the DATE: line with its csv fields run together.  None if there is
+	no DATE line.
+	"""
+	for row in csv.reader(lines):
+		if row and row[0].startswith('DATE:'):
+			dstring = ''.join(row)
+			return dstring[dstring.find(':')+1:]
+	return None
+
+class HeaderIndex:
+	"""
+	Per directory index of log headers, kept in INDEX_NAME next to the
+	logs.  Filters can be checked against it without opening the logs
+	and readers can seek straight to <StartData>.  Entries are refreshed
+	when a file's size or mtime changes.
+	"""
+	def __init__(self,index_name=INDEX_NAME):
+		self.index_name = index_name
+		self.dirs = {}
+		self.dirty = set()
+
+	def load(self,dirname):
+		try:
+			return self.dirs[dirname]
+		except KeyError:
+			pass
+		entries = {}
+		try:
+			fd = open(os.path.join(dirname,self.index_name),'rb')
+			try:
+				entries = cPickle.load(fd)
+			finally:
+				fd.close()
+		except IOError:
+			pass
+		except:
+			print 'Ignoring unreadable index in %s' % dirname
+		self.dirs[dirname] = entries
+		return entries
+
+	def entry(self,filename):
+		(dirname,basename) = os.path.split(os.path.abspath(filename))
+		entries = self.load(dirname)
+		st = os.stat(filename)
+		entry = entries.get(basename)
+		if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+			entry = scan_header(filename)
+			entries[basename] = entry
+			self.dirty.add(dirname)
+		return entry
+
+	def save(self):
+		for dirname in self.dirty:
+			name = os.path.join(dirname,self.index_name)
+			tmpname = '%s.%d.tmp' % (name,os.getpid())
+			try:
+				fd = open(tmpname,'wb')
+				try:
+					cPickle.dump(self.dirs[dirname],fd,2)
+				finally:
+					fd.close()
+				os.rename(tmpname,name)
+			except (OSError,IOError):
+				print 'Could not write header index in %s' % dirname
+		self.dirty = set()
+
+class TrendStore:
+	"""
+	Per log results for battery trends, kept between runs in one file.
+	Each log's run is a dict of its header fields, date, net ACR, disc
+	Wh and average watts, or empty if the log had no usable data.  Runs
+	are keyed on the log's path and go stale when its size or mtime
+	changes, so a trend over many logs only needs a stat of each.  A
+	store saved with different params starts out empty.
+	"""
+	def __init__(self,filename,params=None):
+		self.filename = filename
+		self.params = params
+		self.runs = {}
+		self.dirty = False
+		try:
+			fd = open(filename,'rb')
+			try:
+				(params,runs) = cPickle.load(fd)
+			finally:
+				fd.close()
+			if params == self.params:
+				self.runs = runs
+		except IOError:
+			pass
+		except:
+			print 'Ignoring unreadable trend store %s' % filename
+
+	def run(self,filename):
+		"""The stored run for filename or None if it is missing or stale"""
+		entry = self.runs.get(os.path.abspath(filename))
+		if entry is None:
+			return None
+		st = os.stat(filename)
+		if entry[0] != st.st_size or entry[1] != st.st_mtime:
+			return None
+		return entry[2]
+
+	def update(self,filename,run):
+		st = os.stat(filename)
+		self.runs[os.path.abspath(filename)] = (st.st_size,st.st_mtime,run)
+		self.dirty = True
+
+	def save(self):
+		if not self.dirty:
+			return
+		tmpname = '%s.%d.tmp' % (self.filename,os.getpid())
+		try:
+			fd = open(tmpname,'wb')
+			try:
+				cPickle.dump((self.params,self.runs),fd,2)
+			finally:
+				fd.close()
+			os.rename(tmpname,self.filename)
+		except (OSError,IOError):
+			print 'Could not write trend store %s' % self.filename
+		self.dirty = False
+
+# Columns of a summary table as (name,type).  The header row of the file
+# is name:type so the table can be read back without this list.
+SUMMARY_COLUMNS = [('filename','str'),('build','str'),('batser','str'),
+	('sernum','str'),('xover','str'),('comment','str'),('date','str'),
+	('net_time','float'),('net_acr','float'),('cv_acr','float'),
+	('cv_time','float'),('watthrs','float'),('min_w','float'),
+	('max_w','float'),('avg_w','float'),('chg_wh','float'),
+	('disc_wh','float'),('crit_time','float'),('crit_acr','float'),
+	('max_temp','float'),('temp_rise','float'),('start_v','float'),
+	('cticks','int'),('dticks','int'),('time_valid','int'),
+	('power_valid','int')]
+
+TABLE_TYPES = {'str':str,'float':float,'int':int}
+
+class SummaryTable:
+	"""
+	Per log summaries written to a csv file, one row per log, with the
+	column types in the header row.
+	"""
+	def __init__(self,filename,columns=SUMMARY_COLUMNS):
+		self.columns = columns
+		self.fd = open(filename,'wb')
+		self.writer = csv.writer(self.fd)
+		self.writer.writerow([ '%s:%s' % column for column in columns ])
+
+	def write(self,values):
+		"""values is a dict keyed on column name"""
+		row = []
+		for (name,kind) in self.columns:
+			value = values[name]
+			if kind == 'float':
+				value = repr(float(value))
+			elif kind == 'int':
+				value = int(value)
+			row.append(value)
+		self.writer.writerow(row)
+
+	def close(self):
+		self.fd.close()
+
+def read_summary_table(filename):
+	"""Read a SummaryTable file back as {column name: list of values}"""
+	reader = csv.reader(open(filename,'rb'))
+	columns = [ column.split(':') for column in reader.next() ]
+	table = dict([ (name,[]) for (name,kind) in columns ])
+	for row in reader:
+		for ((name,kind),value) in zip(columns,row):
+			table[name].append(TABLE_TYPES[kind](value))
+	return table
+
+class LogSummary:
+	"""What LogSummarizer works out for one log"""
+	def __init__(self,filename):
+		self.filename		= filename
+		# False if the log could not be read at all
+		self.readable		= False
+		self.build_no		= 'Unknown'
+		self.bat_ser		= 'None'
+		self.lap_ser		= 'None'
+		self.xo_ver		= '1'
+		self.comment		= ''
+		self.rundate_str	= ''
+		self.result		= {}
+		self.time_period_valid	= False
+		self.power_output_valid	= True
+		self.cv_acr		= 0
+		self.cv_time		= 0
+		self.minW		= 50.0
+		self.maxW		= -50.0
+		self.crit_time		= 0
+		self.crit_acr		= 0
+		self.maxTb		= -40.0
+		self.maxTb_rise		= 0
+		self.Vz			= 0.
+		self.charge_ticks	= -1
+		self.discharge_ticks	= -1
+
+	def avg_watts(self):
+		if self.result['Th'] != 0.0:
+			return self.result['Wh']/self.result['Th']
+		return 0.0
+
+	def values(self):
+		"""The summary as a SUMMARY_COLUMNS row"""
+		return {'filename':self.filename,'build':self.build_no,
+			'batser':self.bat_ser.strip(),'sernum':self.lap_ser.strip(),
+			'xover':self.xo_ver,'comment':self.comment,'date':self.rundate_str,
+			'net_time':self.result['Th'],'net_acr':self.result['NetACR'],
+			'cv_acr':self.result['NetACR']-self.cv_acr,
+			'cv_time':self.result['Th']-self.cv_time,
+			'watthrs':self.result['Wh'],'min_w':self.minW,'max_w':self.maxW,
+			'avg_w':self.avg_watts(),'chg_wh':self.result['ChgWh'],
+			'disc_wh':self.result['DiscWh'],'crit_time':self.crit_time,
+			'crit_acr':self.crit_acr,'max_temp':self.maxTb,
+			'temp_rise':self.maxTb_rise,'start_v':self.Vz,
+			'cticks':self.charge_ticks,'dticks':self.discharge_ticks,
+			'time_valid':self.time_period_valid,
+			'power_valid':self.power_output_valid}
+
+class LogSummarizer:
+	"""
+	The per line state machine behind process-pwr_log's summaries.  It
+	only holds settings and everything about a log is kept in the
+	LogSummary it returns, so one summarizer can be handed to pool
+	workers and run over many logs at once.
+	"""
+	# Conversion defs
+	SEC 	= 0
+	SOC 	= 1
+	Vb 	= 2
+	Ib 	= 3
+	Tb 	= 4
+	ACR 	= 5
+
+	# 6.5uV / .015 mOhm sense resistor / 1000 = raw ACR -> ACR in mAh
+	ACR2mAh = 6.25 / .015 / 1000
+
+	# The order of this list is the order of output in the results file.
+	# 'Line' is fixed and needs to be item 0 but all others are fungable.
+	result_items = ['Line','Th','Iavg','NetACR','Deltat','Vavg','Watts','Wh','DeltaTb','DeltaACR','Zavg','ChgWh','DiscWh']
+	result_headers = {'Line':'LineNo','Th':'Net T(hours)','Iavg':'I Avg(mA)',
+		'NetACR':'Net ACR(mA)','Deltat':'dT(sec)','Vavg':'V Avg',
+		'Watts':'Watts','Wh':'Net Wh','DeltaTb':'dTb(C)',
+		'DeltaACR':'dACR(mA)','Zavg':'Zavg','ChgWh':'Chg Wh',
+		'DiscWh':'Dischg Wh'}
+
+	def __init__(self,min_sample_interval=60,min_power_limit=-15,max_power_limit=20,
+			include_errors=False,quiet=True):
+		self.min_sample_interval = min_sample_interval
+		self.min_power_limit	 = min_power_limit
+		self.max_power_limit	 = max_power_limit
+		self.include_errors	 = include_errors
+		self.quiet		 = quiet
+
+	def params(self):
+		"""Everything besides the log itself that changes a summary"""
+		return {'parser':'summary',
+			'min_sample_interval':self.min_sample_interval,
+			'min_power_limit':self.min_power_limit,
+			'max_power_limit':self.max_power_limit,
+			'include_errors':self.include_errors}
+
+	def convert_data(self,filename,row,converted,api):
+		try:
+			# Seconds
+			converted[self.SEC] = float(row[self.SEC])
+			# State of Charge (Convert to float just for consistency)
+			converted[self.SOC] = float(row[self.SOC])
+			# Volts
+			converted[self.Vb] = float(row[self.Vb])/1000000
+			# Current
+			# Gen 1 units have current in uA
+			if api == 2:
+				converted[self.Ib] = float(row[self.Ib])/1000000
+			else:
+				converted[self.Ib] = float(row[self.Ib])/1000
+			# Batt Temp in C
+			converted[self.Tb] = float(row[self.Tb])/100
+		except:
+			if not self.quiet:
+				print "Convert Error: %s" % filename
+				print row
+			return False
+
+		try:
+			# ACR mAh
+			# Old versions of the logging script have this number as an unsinged 16-bit
+			# But its really a 2's complement so you have to fixup to make the math work across
+			# a rollover.
+			if api == 2 :
+				# in gen 1.5 this value is reported converted into uAh
+				converted[self.ACR] = float(row[self.ACR]) / 1000.0
+			else:
+				if int(row[self.ACR]) < 0:
+					# Allready converted. So good go
+					converted[self.ACR] = float(row[self.ACR])*self.ACR2mAh
+				else:
+					intval = int(row[self.ACR])
+					if (intval & 0x8000):
+						intval = -((~intval & 0xffff) +1)
+					converted[self.ACR] = float(intval)*self.ACR2mAh
+		except:
+			print "ACR Error: %s" % filename
+			print row[self.ACR]
+			return False
+
+		return True
+
+	def process_data(self,result,converted,converted_prev,start,line_no):
+		"""start is the (seconds,ACR,temperature) of the first reading"""
+		(Tz,ACRz,Tbz) = start
+		result['Line']		= line_no
+		result['Th'] 		= (converted[self.SEC] - Tz) / 3600
+		result['Deltat']	= converted[self.SEC] - converted_prev[self.SEC]
+		if result['Deltat'] == 0:
+			# Keep /0 from happening
+			result['Deltat'] = 1.0
+		result['DeltaACR'] = (converted[self.ACR] - converted_prev[self.ACR])
+
+		# Small number for these values give high error rates
+		# we want to skip the calc interval in these cases
+		if abs(result['Deltat']) < self.min_sample_interval or abs(result['DeltaACR']) < .5:
+			return False
+
+		result['Iavg'] 	= result['DeltaACR'] / (result['Deltat'] / 3600)
+		result['NetACR']	= converted[self.ACR] - ACRz
+		result['Vavg']	= (converted[self.Vb] + converted_prev[self.Vb]) / 2
+		result['Watts']	= result['Vavg'] * result['Iavg'] / 1000
+		Wh = (result['Watts'] * result['Deltat'] / 3600)
+		result['Wh']	= result['Wh'] + Wh
+		if Wh > 0:
+			result['ChgWh'] = result['ChgWh'] + Wh
+		else:
+			result['DiscWh'] = result['DiscWh'] + Wh
+
+		result['DeltaTb'] = converted[self.Tb] - Tbz
+		if result['Iavg'] != 0.0:
+			result['Zavg'] = result['Vavg'] / result['Iavg']
+		else:
+			result['Zavg'] = 0
+
+		return True
+
+	def pretty_out(self,data):
+		retval = []
+		retval.append('%12d' % data['Line'])
+		for each in self.result_items[1:]:
+			retval.append('%12.3f' % data[each])
+		return retval
+
+	def gnuplot_out(self,data):
+		retval = []
+		retval.append('%f %f' % (data['Th'],data['Watts'] ) )
+		return retval
+
+	def summarize(self,filename,index=None,make_process_file=False,gnuplot=False):
+		"""
+		Run the state machine over one log and return its LogSummary.
+		With make_process_file the per interval results are also written
+		to processed-<filename>.csv, in gnuplot format with gnuplot.
+		index is an optional HeaderIndex to take the header from.
+		"""
+		summary = LogSummary(filename)
+		converted	= [0.,0.,0.,0.,0.,0.]
+		converted_prev 	= converted[:]
+		result 		= dict( [ (i,0.) for i in self.result_items ] )
+		summary.result	= result
+		xo_ver		= '1'
+		kern_api	= 0
+		charge_cnt	= -1
+		charge_soc	= -1
+		discharge_cnt	= -1
+		discharge_soc	= -1
+
+		output_filename = "processed-"+ os.path.splitext(filename)[0] + ".csv"
+		if make_process_file:
+			writer = csv.writer(open(output_filename, "wb"),quoting=csv.QUOTE_NONE)
+
+		if index:
+			# Take the header rows from the index and go straight to the data
+			entry = index.entry(filename)
+			header_rows = csv.reader(entry['lines'])
+			if entry.get('binlog'):
+				reader = BinlogReader(filename,skip_header=True)
+			else:
+				reader = csv.reader(open_log(filename,entry['offset']))
+		else:
+			reader = log_reader(filename)
+			header_rows = reader
+		try:
+			for row in header_rows:
+				if make_process_file:
+					if not gnuplot:
+						writer.writerow(row)
+				if not row:
+					continue
+				try:
+					if row[0].startswith('BUILD:'):
+						summary.build_no = (row[0].split(':')[1]).strip()[:10]
+				except:
+					summary.build_no = 'Err'
+				try:
+					if row[0].startswith('BATSER:'):
+						summary.bat_ser = row[0].split(':')[1]
+				except:
+					summary.bat_ser = 'Err'
+
+				try:
+					if row[0].startswith('SERNUM:'):
+						summary.lap_ser = row[0].split(':')[1]
+				except:
+					summary.lap_ser = 'Err'
+
+				try:
+					if row[0].startswith('XOVER:'):
+						xo_ver = (row[0].split(':')[1]).strip()
+				except:
+					xo_ver ='Err'
+				try:
+					if row[0].startswith('KERNAPI:'):
+						kern_api = int((row[0].split(':')[1]).strip())
+				except:
+					kern_api = 0
+				try:
+					if row[0].startswith('COMMENT:'):
+						summary.comment = row[0].split(':')[1].strip()
+				except:
+					summary.lap_ser = 'Err'
+				try:
+					if row[0].startswith('DATE:'):
+						# Dates can have commas and they get pased as csv so reconstruct
+						# the full string.
+						dstring = ''
+						for each in row:
+							dstring += each
+						dcolon = dstring.find(":")+1
+						dstring = dstring[dcolon:]
+						rundate = parse_header_date(dstring)
+						summary.rundate_str = datetime.strftime(rundate,"%Y/%m/%d %H:%M:%S")
+				except:
+					summary.rundate_str = 'Err'
+					traceback.print_exc(file=sys.stdout)
+
+				try:
+					if row[0].startswith('CHGCNT:'):
+						value = row[0].split(':')[1].strip()
+						chg_msb = int(value.split(' ')[0].strip(),16)
+						chg_lsb = int(value.split(' ')[1].strip(),16)
+						charge_cnt = (chg_msb*128)+chg_lsb
+				except:
+					charge_cnt = -1
+					traceback.print_exc(file=sys.stdout)
+
+				try:
+					if row[0].startswith('CHGSOC:'):
+						value 	= row[0].split(':')[1].strip()
+						charge_soc = int(value.split(' ')[0].strip(),16)
+				except:
+					charge_soc = -1
+					traceback.print_exc(file=sys.stdout)
+
+				try:
+					if row[0].startswith('DISCNT:'):
+						value = row[0].split(':')[1].strip()
+						dischg_msb = int(value.split(' ')[0].strip(),16)
+						dischg_lsb = int(value.split(' ')[1].strip(),16)
+						discharge_cnt = (chg_msb*128)+chg_lsb
+				except:
+					discharge_cnt = -1
+					traceback.print_exc(file=sys.stdout)
+
+				try:
+					if row[0].startswith('DISSOC:'):
+						value 	= row[0].split(':')[1].strip()
+						discharge_soc = int(value.split(' ')[0].strip(),16)
+				except:
+					discharge_soc = -1
+					traceback.print_exc(file=sys.stdout)
+
+				if row[0] == '<StartData>':
+					break
+		except:
+			print "Read Error in: %s" % (filename)
+			return summary
+		summary.xo_ver = xo_ver
+
+		if kern_api == 0:
+			if xo_ver == '1.5':
+				kern_api = 2
+			else:
+				kern_api = 1
+
+		try:
+			row = reader.next()
+		except:
+			if not self.quiet:
+				print "Err: %s line %d " % (filename,reader.line_num)
+			return summary
+		if not (self.convert_data(filename,row,converted,kern_api)):
+			if not self.quiet:
+				print "1-line ",reader.line_num
+			return summary
+
+		if (charge_cnt > -1 and charge_soc > -1):
+			summary.charge_ticks = charge_cnt + charge_soc
+		else:
+			summary.charge_ticks = -1
+
+		if (discharge_cnt > -1 and discharge_soc > -1):
+			summary.discharge_ticks = discharge_cnt + discharge_soc
+		else:
+			summary.discharge_ticks = -1
+
+		header = []
+		for each in self.result_items:
+			header.append("%12s" % self.result_headers[each])
+		if make_process_file:
+			if not gnuplot:
+				writer.writerow(header)
+
+		# Starting point for relative measuements
+		Tz = converted[self.SEC]
+		ACRz = converted[self.ACR]
+		Tbz  = converted[self.Tb]
+		summary.Vz = converted[self.Vb]
+		start = (Tz,ACRz,Tbz)
+		# Setup the first calculation
+		converted_prev = converted[:]
+		# Keep the div by zero from occuring
+		converted_prev[self.SEC] = Tz-1
+		self.process_data(result,converted,converted_prev,start,reader.line_num)
+		# Fixup the errors from the starting entry
+		result['Deltat'] = 0
+		result['Wh'] = 0
+		result['ChgWh'] = 0
+		result['DiscWh'] = 0
+		crit_start = 0
+		crit_time  = 0
+		crit_acr_start = 0
+		crit_acr = 0
+		result['DeltaTb'] = 0
+		# Init min & Max.  This really should be initialized to the
+		# first real value but that does not happen until the 2nd interation
+		# and I feel lazy.  If we ever hit 20W some thing else is wrong anyway
+		# Famous last words. X0-1.5 can hit >20W so up this to 50W
+		minW 		= 50.0
+		maxW 		= -50.0
+		maxTb		= -40.0
+		maxTb_rise	= 0
+		cv_point_reached = 0
+		cv_acr = 0
+		cv_time = 0
+		if make_process_file:
+			if gnuplot:
+				out = []
+				out.append('#xo:%s | build:%s' % (xo_ver,summary.build_no))
+				writer.writerow(out)
+				writer.writerow(self.gnuplot_out(result))
+			else:
+				writer.writerow(self.pretty_out(result))
+		converted_prev = converted[:]
+		# Short log files generated from powerd often don't have enough data in them to meet
+		# minimum sample period for good power readings.  If we get one of those files then
+		# we should just skip it.
+		time_period_valid = False
+		power_output_valid = True
+
+		# Run the rest of the data
+		for row in reader:
+			if not row:
+				continue
+			if not (self.convert_data(filename,row,converted,kern_api)):
+				if not self.quiet:
+					print "line ", reader.line_num
+				else:
+					continue
+			if not self.process_data(result,converted,converted_prev,start,reader.line_num):
+				continue
+
+			if result['Watts'] > self.max_power_limit or result['Watts'] < self.min_power_limit:
+				if not self.include_errors:
+					power_output_valid = False
+					continue
+
+			# Getting here means we got at least 1 power reading that meets the minimum sample
+			# period.
+			time_period_valid = True
+			if result['Watts'] > maxW and (round(result['Watts'],3) != 0.0) :
+				maxW = result['Watts']
+			if (result['Watts'] < minW) and (round(result['Watts'],3) != 0.0):
+				minW = result['Watts']
+			if (result['Vavg'] < 5.725 and crit_start == 0 ):
+				crit_start = result['Th']
+				crit_acr_start = abs(result['NetACR'])
+			else:
+				if crit_start > 0:
+					crit_time = (result['Th'] - crit_start) * 60
+					crit_acr = abs(result['NetACR']) - crit_acr_start;
+
+			if converted[self.Tb] > maxTb:
+				maxTb = converted[self.Tb]
+
+			if result['DeltaTb'] > maxTb_rise:
+				maxTb_rise = result['DeltaTb']
+			if result['Vavg'] >= 7.2 and cv_point_reached==0:
+				cv_point_reached = 1
+				cv_acr  = result['NetACR']
+				cv_time = result['Th']
+
+			converted_prev = converted[:]
+			if make_process_file:
+				if gnuplot:
+					writer.writerow(self.gnuplot_out(result))
+				else:
+					writer.writerow(self.pretty_out(result))
+
+		# Blank lines separate datasets in gnuplot
+		if gnuplot:
+			writer.writerow('');
+			writer.writerow('');
+
+		summary.readable	   = True
+		summary.time_period_valid  = time_period_valid
+		summary.power_output_valid = power_output_valid
+		summary.cv_acr		   = cv_acr
+		summary.cv_time		   = cv_time
+		summary.minW		   = minW
+		summary.maxW		   = maxW
+		summary.crit_time	   = crit_time
+		summary.crit_acr	   = crit_acr
+		summary.maxTb		   = maxTb
+		summary.maxTb_rise	   = maxTb_rise
+		return summary
+
+# The LogSummarizer each pool worker runs
+worker_summarizer = None
+
+def init_summary_worker(summarizer,index,make_process_file=False,gnuplot=False):
+	global worker_summarizer
+	worker_summarizer = (summarizer,index,make_process_file,gnuplot)
+
+def summarize_file(filename):
+	"""
+	Pool worker: summarize one log with the parent's summarizer.  Returns
+	(summary,output) where output is whatever the summarizer printed, so
+	the parent can show it in file order.
+	"""
+	(summarizer,index,make_process_file,gnuplot) = worker_summarizer
+	stdout = sys.stdout
+	sys.stdout = cStringIO.StringIO()
+	try:
+		summary = summarizer.summarize(filename,index,make_process_file,gnuplot)
+		output = sys.stdout.getvalue()
+	finally:
+		sys.stdout = stdout
+	return (summary,output)
+
+def summarize_files(summarizer,filenames,jobs=1,index=None,make_process_file=False,gnuplot=False):
+	"""
+	Generate the LogSummary of each log, in filenames order, using jobs
+	processes.  Anything a worker prints is passed on just before its
+	summary.  The workers get a copy of index, so it is brought up to
+	date for all the files here first and the parent can save it.
+	"""
+	if jobs <= 1:
+		for filename in filenames:
+			yield summarizer.summarize(filename,index,make_process_file,gnuplot)
+		return
+
+	if index:
+		for filename in filenames:
+			try:
+				index.entry(filename)
+			except (OSError,IOError):
+				pass
+
+	pool = multiprocessing.Pool(jobs,init_summary_worker,
+		(summarizer,index,make_process_file,gnuplot))
+	for (summary,output) in pool.imap(summarize_file,filenames):
+		sys.stdout.write(output)
+		yield summary
+	pool.close()
+	pool.join()
+
 class pwr_trace:
 	def __init__(self):
 
@@ -63,12 +1316,16 @@ class PwrLogfile:
 		self.charge_limit=30
 		self.enable_charge_limit=False
 		self.local_tz = tz.tzutc()
+		self.clock = LocalClock(self.local_tz)
 		# The wattage calcs should never be outside these ranges.  If they are 
 		# then there is some sort of error.
 		self.max_watts_limit = 20
 		self.min_watts_limit = -15
 		self.max_Th	     = 50
 		self.powerd_log	     = False
+		self.cache	     = None
+		self.cached	     = None
+		self.errors	     = []
 
 	def convert_data(self,row):
 		converted = [0.,0.,0.,0.,0.,0.,"","",""]
@@ -106,15 +1363,12 @@ class PwrLogfile:
 		if self.powerd_log:
 			converted[self.EVENT] = row[self.EVENT]
 		
-		dt_sample = datetime.fromtimestamp(converted[self.SEC],tz.tzutc())
-		converted[self.DATESTR] = dt_sample.strftime("%Y-%m-%d %H:%M:%S")
+		converted[self.DATESTR] = self.clock.utc_date_string(converted[self.SEC])
 		return converted
 
 	def process_data(self,converted, converted_prev):
 		result = [0.,0.,0.,0.,0.,0.,0.,0.,0.,0.]
-		dt_sample = datetime.fromtimestamp(converted[self.SEC],tz.tzutc())
-		dt_tz = dt_sample.astimezone(self.local_tz).timetuple()
-		result[self.Ttod] = float(dt_tz.tm_hour) + float(dt_tz.tm_min)/60.0
+		result[self.Ttod] = self.clock.time_of_day(converted[self.SEC])
 	        result[self.Th]      = (converted[self.SEC] - self.Tz) / 3600
         	result[self.Deltat]  = converted[self.SEC] - converted_prev[self.SEC]
 		if result[self.Deltat] == 0:
@@ -153,7 +1407,15 @@ class PwrLogfile:
 
 	def parse_header(self,filename):
 		self.filename = filename
-		self.reader = csv.reader(open(filename,"rb"))
+		self.cached = None
+		if self.cache:
+			self.cached = self.cache.load(filename,{'parser':'records'})
+			if self.cached is not None:
+				(header,self.powerd_log,self.local_tz) = self.cached[:3]
+				self.header = dict(header)
+				self.clock = LocalClock(self.local_tz)
+				return
+		self.reader = log_reader(filename)
 		# Read the header into a dictionary
 		# Default to XO version 1 since it does not exist in earlier
 		# header formats
@@ -174,7 +1436,7 @@ class PwrLogfile:
 				dcolon = dstring.find(":")+1
 				dstring = dstring[dcolon:]
 				self.header['date_string'] = dstring
-                                rundate = parser.parse(dstring,fuzzy=True)
+                                rundate = parse_header_date(dstring)
 				self.header['DATE'] = rundate
 				continue
 
@@ -208,6 +1470,7 @@ class PwrLogfile:
 		if self.local_tz == None:
 			print "File: %s Unknown TZ: %s" % (filename,dstring)
 			self.local_tz = tz.tzutc()
+		self.clock = LocalClock(self.local_tz)
 		
 		self.header['log_date'] = self.header['DATE'].astimezone(tz.tzutc())
 		self.header['log_tz'] = str(self.header['log_date'])[-6:]
@@ -221,9 +1484,8 @@ class PwrLogfile:
 	def get_headers(self):
 		return self.header
 
-	def parse_records(self):
-		records = []
-		errors = []
+	def convert_rows(self,errors):
+		"""Generate converted records from the data rows, adding bad lines to errors"""
 		for row in self.reader:
 			if not row:
 				continue
@@ -232,13 +1494,159 @@ class PwrLogfile:
 			except:
 				errors.append( (self.reader.line_num,sys.exc_info()) )
 				continue
-			records.append(converted)
-				
+			yield converted
+
+	def iter_records(self,start=None,end=None,events=None):
+		"""
+		Generate the converted records of the file opened by parse_header
+		one at a time instead of building the whole list.  Only records
+		with start <= seconds <= end, and an event containing one of the
+		events strings, are yielded.  Every line is still converted so
+		self.errors ends up with the same line errors parse_records gives.
+		"""
+		self.errors = []
+		if self.cached is not None or self.cache:
+			# Served from, or filling, the cache as parse_records is
+			(records,errors) = self.parse_records()
+			self.errors.extend(errors)
+		else:
+			records = self.convert_rows(self.errors)
+		for converted in records:
+			sec = converted[self.SEC]
+			if start is not None and sec < start:
+				continue
+			if end is not None and sec > end:
+				continue
+			if events is not None and not self.has_event(converted,events):
+				continue
+			yield converted
+
+	def has_event(self,converted,events):
+		"""True if the record's event contains one of the events strings"""
+		for event in events:
+			if converted[self.EVENT].find(event) != -1:
+				return True
+		return False
+
+	def tail_records(self,offset,line_num,events=None):
+		"""
+		Convert the lines of the text log opened by parse_header from
+		offset on, where offset is the start of line line_num+1 in the
+		uncompressed log.  Returns (records,errors,offset,line_num,partial)
+		to carry on from next time.  A last line without its newline is
+		converted into partial but not counted as read: the logger may
+		still be writing it, or the log was cut off and it never will.
+		Errors on that line are not reported.  With events only the lines
+		scan_events picks out are converted.
+		"""
+		fd = open_log(self.filename,offset)
+		try:
+			data = fd.read()
+		finally:
+			fd.close()
+		end = data.rfind('\n') + 1
+		lines = data.count('\n',0,end)
+		(records,errors) = self.convert_lines(data[:end],line_num,events)
+		(partial,partial_errors) = self.convert_lines(data[end:],line_num + lines,events)
+		return (records,errors,offset + end,line_num + lines,partial)
+
+	def convert_lines(self,data,line_num,events=None):
+		"""
+		Convert the lines in data, which follow line line_num, filtered
+		on events as iter_records does.  Returns (records,errors).
+		"""
+		if events is not None:
+			return self.scan_events(data,line_num,events)
+		reader = csv.reader(data.splitlines(True))
+		records = []
+		errors = []
+		for row in reader:
+			if not row:
+				continue
+			try:
+				records.append(self.convert_data(row))
+			except:
+				errors.append( (line_num + reader.line_num,sys.exc_info()) )
+		return (records,errors)
+
+	def scan_events(self,data,line_num,events):
+		"""
+		Convert just the lines of data that contain one of the events
+		strings.  data is whole lines following line line_num.  The lines
+		are found by searching the whole buffer, so lines without an
+		event are never split or converted and their errors go
+		unreported.  Returns (records,errors) with records filtered on the
+		event column as iter_records does.
+		"""
+		starts = set()
+		for event in events:
+			pos = data.find(event)
+			while pos != -1:
+				starts.add(data.rfind('\n',0,pos) + 1)
+				pos = data.find('\n',pos)
+				if pos == -1:
+					break
+				pos = data.find(event,pos)
+
+		records = []
+		errors = []
+		prev = 0
+		for start in sorted(starts):
+			line_num += data.count('\n',prev,start)
+			prev = start
+			stop = data.find('\n',start)
+			if stop == -1:
+				stop = len(data)
+			for row in csv.reader([data[start:stop]]):
+				try:
+					converted = self.convert_data(row)
+				except:
+					errors.append( (line_num + 1,sys.exc_info()) )
+					continue
+				if self.has_event(converted,events):
+					records.append(converted)
+		return (records,errors)
+
+	def binlog_events(self,events):
+		"""
+		The binary log version of scan_events: only records whose event
+		column contains one of the events strings are converted.
+		Returns (records,errors).
+		"""
+		records = []
+		errors = []
+		if not self.powerd_log:
+			# No event column so nothing can match
+			return (records,errors)
+		reader = BinlogReader(self.filename,skip_header=True)
+		for row in reader:
+			for event in events:
+				if row[self.EVENT].find(event) != -1:
+					break
+			else:
+				continue
+			try:
+				records.append(self.convert_data(row))
+			except:
+				errors.append( (reader.line_num,sys.exc_info()) )
+		return (records,errors)
+
+	def parse_records(self):
+		if self.cached is not None:
+			return self.cached[3]
+		errors = []
+		records = list(self.convert_rows(errors))
+
+		if self.cache:
+			# Tracebacks can't be pickled
+			saved_errors = [ (line,(e[0],e[1],None)) for (line,e) in errors ]
+			self.cache.store(self.filename,{'parser':'records'},
+				(self.header.copy(),self.powerd_log,self.local_tz,(records,saved_errors)))
 		return (records,errors)
 
 	def read_file(self,filename):
 		data = []
-		reader = csv.reader(open(filename,"rb"))
+		reader = log_reader(filename)
 		# Read the header into a dictionary
 		# Default to XO version 1 since it does not exist in earlier
 		# header formats
@@ -258,7 +1666,7 @@ class PwrLogfile:
 					dstring += each
 				dcolon = dstring.find(":")+1
 				dstring = dstring[dcolon:]
-                                rundate = parser.parse(dstring,fuzzy=True)
+                                rundate = parse_header_date(dstring)
 				self.header['DATE'] = rundate
 				continue
 
@@ -276,6 +1684,7 @@ class PwrLogfile:
 		if self.local_tz == None:
 			print "File: %s Unknown TZ: %s" % (filename,dstring)
 			self.local_tz = tz.tzutc()
+		self.clock = LocalClock(self.local_tz)
 
 		# Now read in the data
 		try:
@@ -340,6 +1749,9 @@ class PwrLogfile:
 	def set_min_sample_interval(self,interval):
 		self.min_sample_interval=interval
 
+	def set_cache(self,cache):
+		self.cache = cache
+
 	def set_charge_limit(self,limit):
 		self.enable_charge_limit=True
 		self.charge_limit=limit
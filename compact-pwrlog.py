@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+# Copyright One Laptop Per Child
+# Released under GPLv2 or later
+
+# Convert text power logs to the binary log format olpcpwrlog reads
+# natively.
+
+import os.path
+import sys
+import argparse
+
+import olpcpwrlog
+
+def main():
+
+	parser = argparse.ArgumentParser(description='convert pwrlogs to the compact binary format')
+	parser.add_argument('filenames', nargs='+', help='files to convert')
+	parser.add_argument('--outdir', default=None,
+		help='Write the binary logs here instead of next to the text logs')
+	parser.add_argument('--remove', action='store_true',
+		help='Remove each text log once it has been converted')
+
+	args = parser.parse_args()
+
+	failed = 0
+	for fname in args.filenames:
+		if olpcpwrlog.is_binlog(fname):
+			continue
+		base = os.path.splitext(fname)[0]
+		if olpcpwrlog.log_compression(fname):
+			# pwr-01.csv.gz -> pwr-01.pwrb
+			base = os.path.splitext(base)[0]
+		binname = base + olpcpwrlog.BINLOG_EXT
+		if args.outdir:
+			binname = os.path.join(args.outdir,os.path.basename(binname))
+		try:
+			olpcpwrlog.write_binlog(fname,binname)
+		except (ValueError,IOError),err:
+			print "%s : Not converted. %s" % (fname,err)
+			failed += 1
+			continue
+		if args.remove:
+			os.remove(fname)
+		print "%s -> %s" % (fname,binname)
+
+	if failed:
+		sys.exit(1)
+
+main()
@@ -17,27 +17,43 @@ from matplotlib.ticker import MultipleLocator
 from pylab import figure, show, normpdf
 import matplotlib.pyplot as plt
 import argparse
+import multiprocessing
+import cPickle
 from datetime import datetime, date, time
 from dateutil import tz, parser
 from matplotlib.backends.backend_pdf import PdfPages
+import olpcpwrlog
 #from scipy.interpolate import interp1d
 
 class pwr_trace:
-	def __init__(self):
+	"""
+	Everything PwrLogfile.read_file works out for one log.  Keeping it
+	here rather than in PwrLogfile lets files be read in parallel.
+	"""
+	def __init__(self,filename):
 
+		self.filename = filename
 		self.header = {}
+		self.local_tz = tz.tzutc()
+		self.clock = olpcpwrlog.LocalClock(self.local_tz)
 
 		self.Tz	     	 = 0.
 		self.ACRz	 = 0.
 		self.Wh_sum	 = 0.
+		self.chgwh_sum	 = 0.
+		self.discwh_sum	 = 0.
 		self.interval_Wh = 0.
 
+		# True once the file has passed the filters and has good power data
+		self.valid	 = False
+		# olpcpwrlog.LogSummary when read_traces was given a summarizer
+		self.summary	 = None
+
 		# Small arrry for a place holder will will replace this once we have built the data list
-		self.darray	= zeros(3)
+		self.darray	= np.zeros(3)
 
 class PwrLogfile:
 	def __init__(self):
-		self.header = {}
 		# 6.5uV / .015 mOhm sense resistor / 1000 = raw ACR -> ACR in mAh
 		self.ACR2mAh = 6.25 / .015 / 1000
 		# Conversion defs
@@ -48,12 +64,6 @@ class PwrLogfile:
 		self.Tb      = 4
 		self.ACR     = 5
 
-		self.Tz	     	= 0.
-		self.ACRz	= 0.
-		self.Wh_sum	= 0.
-		self.chgwh_sum	= 0.
-		self.discwh_sum = 0.
-
 		# Results defs
 		self.Th      = 0
 		self.Iavg    = 1
@@ -68,19 +78,18 @@ class PwrLogfile:
 		self.ChgWh   = 10
 		self.DiscWh  = 11
 
-		# Small arrry for a place holder will will replace this once we have built the data list
-		self.darray	= np.zeros(3)
 		self.min_sample_interval = 0
 		self.charge_limit=30
 		self.enable_charge_limit=False
-		self.local_tz = tz.tzutc()
 		# The wattage calcs should never be outside these ranges.  If they are
 		# then there is some sort of error.
 		self.max_watts_limit = 20
 		self.min_watts_limit = -15
 		self.max_Th	     = 50
+		self.cache	     = None
+		self.index	     = None
 
-	def convert_data(self,row):
+	def convert_data(self,trace,row):
 		converted = [0.,0.,0.,0.,0.,0.]
                 # Seconds
                 converted[self.SEC] = float(row[self.SEC])
@@ -96,7 +105,7 @@ class PwrLogfile:
 	        # Old versions of the logging script have this number as an unsinged 16-bit
                 # But its really a 2's complement so you have to fixup to make the math work across
         	# a rollover.
-		if self.header['XOVER'] == '1.5' or self.header['KERNAPI'] == '2':
+		if trace.header['XOVER'] == '1.5' or trace.header['KERNAPI'] == '2':
                         # in gen 1.5 this value is reported converted into uAh
                         converted[self.ACR] = float(row[self.ACR]) / 1000.0
 		else:
@@ -112,12 +121,10 @@ class PwrLogfile:
 
 		return converted
 
-	def process_data(self,converted, converted_prev, skip_short_checks=False):
+	def process_data(self,trace,converted, converted_prev, skip_short_checks=False):
 		result = [0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.,0.]
-		dt_sample = datetime.fromtimestamp(converted[self.SEC],tz.tzutc())
-		dt_tz = dt_sample.astimezone(self.local_tz).timetuple()
-		result[self.Ttod] = float(dt_tz.tm_hour) + float(dt_tz.tm_min)/60.0
-	        result[self.Th]      = (converted[self.SEC] - self.Tz) / 3600
+		result[self.Ttod] = trace.clock.time_of_day(converted[self.SEC])
+	        result[self.Th]      = (converted[self.SEC] - trace.Tz) / 3600
         	result[self.Deltat]  = converted[self.SEC] - converted_prev[self.SEC]
 		if result[self.Deltat] == 0:
 			#avoid the /0 error
@@ -131,7 +138,7 @@ class PwrLogfile:
 				return (result,1)
 
 	        result[self.Iavg]    = DeltaACR / (result[self.Deltat] / 3600)
-	        result[self.NetACR]  = converted[self.ACR] - self.ACRz
+	        result[self.NetACR]  = converted[self.ACR] - trace.ACRz
 	        result[self.Vavg]    = (converted[self.Vb] + converted_prev[self.Vb]) / 2
         	result[self.Watts]   = result[self.Vavg] * (result[self.Iavg] / 1000)
 
@@ -143,14 +150,14 @@ class PwrLogfile:
 
 		# Keep a copy of the sample Wh so we can adjust things correctly when computing
 		# the final interval
-		self.interval_Wh     =  (result[self.Watts] * result[self.Deltat] / 3600)
+		trace.interval_Wh     =  (result[self.Watts] * result[self.Deltat] / 3600)
 
-		if self.interval_Wh > 0:
-			result[self.ChgWh]  = self.chgwh_sum  + self.interval_Wh
+		if trace.interval_Wh > 0:
+			result[self.ChgWh]  = trace.chgwh_sum  + trace.interval_Wh
 		else:
-			result[self.DiscWh] = self.discwh_sum + self.interval_Wh
+			result[self.DiscWh] = trace.discwh_sum + trace.interval_Wh
 
-	        result[self.Wh]      = self.Wh_sum + self.interval_Wh
+	        result[self.Wh]      = trace.Wh_sum + trace.interval_Wh
 
 		if result[self.Th] != 0.0:
 			result[self.Wavg]    = result[self.Wh] / result[self.Th]
@@ -165,16 +172,47 @@ class PwrLogfile:
 		return (result,0)
 
 	def read_file(self,filename,builds=[],serials=[],xovers=[],models=[]):
-		data = []
+		"""
+		Read and process one log.  Returns a pwr_trace; its valid flag is
+		False if the file was filtered out or had no usable power data.
+		"""
+		trace = pwr_trace(filename)
 		if os.stat(filename).st_size == 0:
-			return False
-
-		reader = csv.reader(open(filename,"rb"))
+			return trace
+
+		# The index lets us skip filtered out files without opening them
+		if self.index:
+			entry = self.index.entry(filename)
+			if not self.header_selected(entry['fields'],builds,serials,xovers,models):
+				return trace
+
+		if self.cache:
+			cached = self.cache.load(filename,self.cache_params())
+			if cached is not None:
+				(header,trace.local_tz,darray,valid) = cached
+				trace.header = dict(header)
+				trace.clock = olpcpwrlog.LocalClock(trace.local_tz)
+				if self.header_selected(trace.header,builds,serials,xovers,models) and valid:
+					trace.darray = darray
+					trace.valid = True
+				return trace
+
+		fd = None
+		if self.index:
+			binlog = entry.get('binlog')
+			reader = csv.reader(entry['lines'])
+		else:
+			binlog = olpcpwrlog.is_binlog(filename)
+			if binlog:
+				reader = olpcpwrlog.BinlogReader(filename)
+			else:
+				fd = olpcpwrlog.open_log(filename)
+				reader = csv.reader(fd)
 		# Read the header into a dictionary
 		# Default to XO version 1 since it does not exist in earlier
 		# header formats
-		self.header['XOVER'] = '1'
-		self.header['KERNAPI'] = '0'
+		trace.header['XOVER'] = '1'
+		trace.header['KERNAPI'] = '0'
 		try:
 			for row in reader:
 				if not row:
@@ -190,24 +228,53 @@ class PwrLogfile:
 						dstring += each
 					dcolon = dstring.find(":")+1
 					dstring = dstring[dcolon:]
-					rundate = parser.parse(dstring,fuzzy=True)
-					self.header['DATE'] = rundate
+					rundate = olpcpwrlog.parse_header_date(dstring)
+					trace.header['DATE'] = rundate
 					continue
 
 				try:
 					values = row[0].split(':')
 					if len(values) > 1:
-						self.header[values[0]] = values[1].strip()
+						trace.header[values[0]] = values[1].strip()
 					elif len(values) > 0:
-						self.header[values[0]] = ''
+						trace.header[values[0]] = ''
 				except:
 					print 'Error in header: %s' % (filename)
 		except:
 			print 'Read error in %s line: %d' % (filename,reader.line_num)
 
+		if not self.header_selected(trace.header,builds,serials,xovers,models):
+			return trace
+
+		# Set the local timzone for where the data came from
+		try:
+			trace.local_tz = trace.header['DATE'].tzinfo
+
+			if trace.local_tz == None:
+				print "File: %s Unknown TZ: %s" % (filename,dstring)
+				trace.local_tz = tz.tzutc()
+		except:
+			print "File: %s 'DATE' processing problem" % (filename)
+			trace.local_tz = tz.tzutc()
+		trace.clock = olpcpwrlog.LocalClock(trace.local_tz)
+
+		if binlog:
+			trace.valid = self.read_binlog_data(trace,filename)
+		else:
+			if self.index:
+				fd = olpcpwrlog.open_log(filename,entry['offset'])
+			trace.valid = self.read_data(trace,fd,reader,filename)
+		if not trace.valid:
+			trace.darray = None
+		if self.cache:
+			self.cache.store(filename,self.cache_params(),(trace.header,trace.local_tz,trace.darray,trace.valid))
+		return trace
+
+	def header_selected(self,header,builds,serials,xovers,models):
+		"""Apply the --build/--sernum/--xover/--model filters to the header"""
 		if len(builds) > 0:
 			found = False
-			buildstr = self.header['BUILD'].lower()
+			buildstr = header['BUILD'].lower()
 			for each in builds:
 				if each in buildstr:
 					found = True
@@ -216,93 +283,218 @@ class PwrLogfile:
 				return False
 
 		if len(serials) > 0:
-			if not (self.header['SERNUM'].upper() in serials):
+			if not (header['SERNUM'].upper() in serials):
 				return False
 
 		if len(xovers) > 0:
-			if not self.header['XOVER'] in xovers:
+			if not header['XOVER'] in xovers:
 				return False
 
 		if len(models) > 0:
-			if not self.header['MODEL'] in models:
+			if not header['MODEL'] in models:
 				return False
 
-		# Set the local timzone for where the data came from
-		try:
-			self.local_tz = self.header['DATE'].tzinfo
-
-			if self.local_tz == None:
-				print "File: %s Unknown TZ: %s" % (filename,dstring)
-				self.local_tz = tz.tzutc()
-		except:
-			print "File: %s 'DATE' processing problem" % (filename)
-			self.local_tz = tz.tzutc()
+		return True
 
+	def read_data(self,trace,fd,reader,filename):
 		# Now read in the data
+		(raw,line_nums) = self.load_data_block(fd,reader.line_num,filename)
+		if len(raw) == 0:
+			print 'Conversion error in %s line: %d' % (filename,reader.line_num)
+			return False
+
 		try:
-			converted = self.convert_data(reader.next())
-			converted_prev = converted[:]
+			cols = self.convert_columns(trace,raw)
 		except:
-			print 'Conversion error in %s line: %d' % (filename,reader.line_num)
+			print 'Conversion error in %s line: %d' % (filename,line_nums[0])
 			traceback.print_exc(file=sys.stdout)
 			return False
 
-		self.Tz   = converted_prev[self.SEC]
-		self.ACRz = converted_prev[self.ACR]
-		self.Wh_sum = 0.
-		self.chgwh_sum  = 0.
-		self.discwh_sum = 0.
-		# This keeps the division by zero error from occurring but does not generate
-		# a huge number because the ACRs are equal and you get zero for the result
-		converted_prev[self.SEC] = self.Tz-1
-
-		# Process the first line with my fabricated previous data
-		results,error = self.process_data(converted, converted_prev)
-		self.Wh_sum = results[self.Wh]
-		self.chgwh_sum  = results[self.ChgWh]
-		self.discwh_sum = results[self.DiscWh]
-		# Start real previous data
-		converted_prev = converted[:]
-
-		converted.extend(results)
-		data.append(converted)
-
-		power_data_valid = False
-		row_processed = False
-
-		# read the rest of the file
+		return self.process_columns(trace,cols,line_nums,filename)
+
+	def read_binlog_data(self,trace,filename):
+		"""read_data for a binary log, straight from the mapped records"""
+		(info,records) = olpcpwrlog.load_binlog(filename)
+		if len(records) == 0:
+			print 'Conversion error in %s line: %d' % (filename,len(info['lines']))
+			return False
+
+		# Same column order as load_data_block gives
+		raw = np.empty((len(records),self.ACR+1))
+		for (i,name) in enumerate(('sec','soc','voltage','current','temp','acr')):
+			raw[:,i] = records[name]
+		line_nums = len(info['lines']) + 1 + np.arange(len(records),dtype=np.int64)
+		cols = self.convert_columns(trace,raw)
+		return self.process_columns(trace,cols,line_nums,filename)
+
+	def load_data_block(self,fd,line_num,filename):
+		"""
+		Load the rows after <StartData> into a float array with one
+		column per raw field (sec,soc,vb,ib,tb,acr).  Rows that don't
+		convert are reported and dropped just like the per-row reader did.
+		Returns the array and the file line number of each row.
+		"""
+		rows = []
+		line_nums = []
 		try:
-			for row in reader:
-				if not row:
-					continue
-				row_processed = False
+			for line in fd:
+				line_num += 1
+				fields = line.split(',',self.ACR+1)
+				if len(fields) > self.ACR:
+					rows.append(fields[:self.ACR+1])
+					line_nums.append(line_num)
+				elif line.strip():
+					print '%s : Conversion error line: %d' % (filename,line_num)
+		except:
+			print '%s : Read error line: %d' % (filename,line_num)
+
+		try:
+			raw = np.array(rows,dtype=np.float64)
+		except ValueError:
+			# Some row has junk in it.  Find it the slow way.
+			good = []
+			good_nums = []
+			for row,num in zip(rows,line_nums):
 				try:
-					converted = self.convert_data(row)
-					results,error = self.process_data(converted, converted_prev)
-					if error == 2:
-						print '%s : Wattage error line: %d' % (filename,reader.line_num)
-						return False
-					if error == 3:
-						print '%s : Elapsed time error line: %d' % (filename,reader.line_num)
-						return False
-					if error:
-						continue
-				except:
-					print '%s : Conversion error line: %d' % (filename,reader.line_num)
-					traceback.print_exc(file=sys.stdout)
-					continue
+					good.append([float(x) for x in row])
+					good_nums.append(num)
+				except ValueError:
+					print '%s : Conversion error line: %d' % (filename,num)
+			raw = np.array(good,dtype=np.float64)
+			line_nums = good_nums
+
+		return (raw.reshape(-1,self.ACR+1),np.array(line_nums,dtype=np.int64))
+
+	def convert_columns(self,trace,raw):
+		"""
+		Array version of convert_data.  Returns a dict of columns in
+		engineering units.
+		"""
+		cols = {}
+		cols['sec'] = raw[:,self.SEC]
+		cols['soc'] = raw[:,self.SOC]
+		cols['vb']  = raw[:,self.Vb] / 1000000
+		cols['ib']  = raw[:,self.Ib] / 1000
+		cols['tb']  = raw[:,self.Tb] / 100
+		if trace.header['XOVER'] == '1.5' or trace.header['KERNAPI'] == '2':
+			cols['acr'] = raw[:,self.ACR] / 1000.0
+		else:
+			# Same 16-bit 2's complement fixup as convert_data.  Negative
+			# values have already been converted by the logger.
+			intval = raw[:,self.ACR].astype(np.int64)
+			wrapped = (intval >= 0) & ((intval & 0x8000) != 0)
+			intval[wrapped] = (intval[wrapped] & 0xffff) - 0x10000
+			cols['acr'] = intval * self.ACR2mAh
+		return cols
+
+	def select_intervals(self,sec,acr):
+		"""
+		Pick the rows process_data would accept.  Each row is compared
+		against the last accepted row so this has to be a scan, but it only
+		touches two floats per row.  Row 0 is the starting point.
+		"""
+		sec_l = sec.tolist()
+		acr_l = acr.tolist()
+		min_interval = self.min_sample_interval
+		selected = [0]
+		sec_prev = sec_l[0]
+		acr_prev = acr_l[0]
+		for i in xrange(1,len(sec_l)):
+			dt = sec_l[i] - sec_prev
+			if dt == 0:
+				dt = 1.0
+			if abs(dt) < min_interval or abs(acr_l[i] - acr_prev) < .5:
+				continue
+			selected.append(i)
+			sec_prev = sec_l[i]
+			acr_prev = acr_l[i]
+		return np.array(selected,dtype=np.intp)
+
+	def time_of_day(self,trace,secs):
+		"""
+		Local time of day (hours + minutes/60) for an array of timestamps.
+		The zone is only asked for its UTC offset once per DST interval.
+		"""
+		if len(secs) == 0:
+			return np.zeros(0)
+		intervals = olpcpwrlog.utc_offset_intervals(trace.local_tz,secs.min(),secs.max())
+		starts  = np.array([x[0] for x in intervals])
+		offsets = np.array([x[1] for x in intervals])
+		local = secs + offsets[np.searchsorted(starts,secs,side='right') - 1]
+		return np.floor(local / 3600) % 24 + (np.floor(local / 60) % 60) / 60.0
+
+	def process_columns(self,trace,cols,line_nums,filename):
+		"""
+		Array version of the process_data loop.  Builds trace.darray from
+		the first row plus every accepted interval.
+		"""
+		sec = cols['sec']
+		acr = cols['acr']
+		trace.Tz   = sec[0]
+		trace.ACRz = acr[0]
+
+		sel = self.select_intervals(sec,acr)
+		prev = sel[:-1]
+		cur  = sel[1:]
+
+		n = len(sel)
+		d = {}
+		for name in ('sec','soc','vb','ib','tb','acr'):
+			d[name] = cols[name][sel]
+		d['th'] = (d['sec'] - trace.Tz) / 3600
+		d['deltat'] = np.ones(n)
+		d['deltat'][1:] = sec[cur] - sec[prev]
+		d['deltat'][d['deltat'] == 0] = 1.0
+		for name in ('iavg','netacr','vavg','watts'):
+			d[name] = np.zeros(n)
+		d['iavg'][1:]   = (acr[cur] - acr[prev]) / (d['deltat'][1:] / 3600)
+		d['netacr'][1:] = acr[cur] - trace.ACRz
+		d['vavg'][1:]   = (cols['vb'][cur] + cols['vb'][prev]) / 2
+		d['watts'][1:]  = d['vavg'][1:] * (d['iavg'][1:] / 1000)
+
+		# The first bad interval ends the file the same way process_data
+		# errors 2 and 3 did.
+		bad_watts = (d['watts'] > self.max_watts_limit) | (d['watts'] < self.min_watts_limit)
+		bad_th = (d['th'] > self.max_Th) | (d['th'] < 0)
+		bad_watts[0] = bad_th[0] = False
+		bad = np.flatnonzero(bad_watts | bad_th)
+		if len(bad):
+			if bad_watts[bad[0]]:
+				print '%s : Wattage error line: %d' % (filename,line_nums[sel[bad[0]]])
+			else:
+				print '%s : Elapsed time error line: %d' % (filename,line_nums[sel[bad[0]]])
+			return False
 
-				row_processed = True
-				power_data_valid = True
-				self.Wh_sum = results[self.Wh]
-				self.chgwh_sum  = results[self.ChgWh]
-				self.discwh_sum = results[self.DiscWh]
-				converted_last_full_interval = converted_prev[:]
-				converted_prev = converted[:]
-				converted.extend(results)
-				data.append(converted)
-		except:
-			print '%s : Read error line: %d' % (filename,reader.line_num)
+		interval_wh = d['watts'] * d['deltat'] / 3600
+		interval_wh[0] = 0.
+		d['wh'] = np.cumsum(interval_wh)
+
+		# Charge and discharge sums restart whenever the sign of the
+		# interval flips, as they do in process_data.
+		chg = interval_wh > 0
+		index = np.arange(n)
+		for name,mask in (('chgwh',chg),('discwh',~chg)):
+			run_sum = np.cumsum(np.where(mask,interval_wh,0.))
+			last_reset = np.maximum.accumulate(np.where(mask,-1,index))
+			base = np.where(last_reset >= 0,run_sum[np.maximum(last_reset,0)],0.)
+			d[name] = np.where(mask,run_sum - base,0.)
+		d['chgwh'][0] = d['discwh'][0] = 0.
+
+		with np.errstate(divide='ignore',invalid='ignore'):
+			d['wavg'] = np.where(d['th'] != 0,d['wh'] / d['th'],0.)
+			d['zavg'] = np.where(d['iavg'] != 0,d['vavg'] / d['iavg'],0.)
+		d['wavg'][0] = d['zavg'][0] = 0.
+		d['tod'] = self.time_of_day(trace,d['sec'])
+
+		names = 'sec,soc,vb,ib,tb,acr,th,iavg,netacr,deltat,vavg,watts,wh,wavg,tod,zavg,chgwh,discwh'
+		trace.darray = np.rec.fromarrays([d[x] for x in names.split(',')],names=names)
+
+		trace.Wh_sum     = d['wh'][-1]
+		trace.chgwh_sum  = d['chgwh'][-1]
+		trace.discwh_sum = d['discwh'][-1]
+		trace.interval_Wh = interval_wh[-1]
+
+		power_data_valid = n > 1
 
 		# If the last row of the file is not processed due to short a time period
 		# then back up to the start of the last good interval and process the last entry
@@ -310,46 +502,74 @@ class PwrLogfile:
 		# the final numbers in the counts for net time and net ACR.
 		# This helps up when processing the olpc-batcap logs which have lots of 1 second
 		# samples near the end
-		if not row_processed:
+		last = len(sec) - 1
+		if power_data_valid and sel[-1] != last:
 			# We should have already caught any serious errors when we tried to process it the
 			# first time.  So if it fails for some reason then just ignore it.
 			try:
 				# Back out the Wh sum from the record we are about to replace
-				self.Wh_sum -= self.interval_Wh
-				self.chgwh_sum -= self.interval_Wh
-				self.discwh_sum -= self.interval_Wh
+				trace.Wh_sum -= trace.interval_Wh
+				trace.chgwh_sum -= trace.interval_Wh
+				trace.discwh_sum -= trace.interval_Wh
+				converted = [cols[x][last] for x in ('sec','soc','vb','ib','tb','acr')]
+				converted_last_full_interval = [cols[x][sel[-2]] for x in ('sec','soc','vb','ib','tb','acr')]
 				# Compute the results from the last good intervals start until the
 				# end of the file.
-				results,error = self.process_data(converted, converted_last_full_interval)
-				power_data_valid = True
-				self.Wh_sum    = results[self.Wh]
-				self.chgwh_sum = results[self.ChgWh]
-				self.discwh_sum = results[self.DiscWh]
+				results,error = self.process_data(trace,converted, converted_last_full_interval)
+				trace.Wh_sum    = results[self.Wh]
+				trace.chgwh_sum = results[self.ChgWh]
+				trace.discwh_sum = results[self.DiscWh]
 				converted.extend(results)
 				# Replace the last interval calc with this new one.
-				data[-1] = converted
+				trace.darray[-1] = tuple(converted)
 			except:
 				pass
 
-		# Add the various init things to the header info for all the net diff calcs
-		self.darray = np.rec.fromrecords(data,names='sec,soc,vb,ib,tb,acr,th,iavg,netacr,deltat,vavg,watts,wh,wavg,tod,zavg,chgwh,discwh')
-
-		if not power_data_valid:
-			return False
-		else:
-			return True
+		return power_data_valid
 
 	def set_min_sample_interval(self,interval):
 		self.min_sample_interval=interval
 
+	def set_cache(self,cache):
+		self.cache = cache
+
+	def set_index(self,index):
+		self.index = index
+
+	def cache_params(self):
+		"""Everything besides the file itself that changes what read_file produces"""
+		return {'parser':'graph',
+			'min_sample_interval':self.min_sample_interval,
+			'max_watts_limit':self.max_watts_limit,
+			'min_watts_limit':self.min_watts_limit,
+			'max_Th':self.max_Th}
+
 	def set_charge_limit(self,limit):
 		self.enable_charge_limit=True
 		self.charge_limit=limit
 
-def acr_trend_compare(a, b):
-	return cmp(a[0],b[0])
+def trend_run(trace):
+	"""What a TrendStore keeps for a trace"""
+	if not trace.valid:
+		return {}
+	header = {}
+	for key in ('BATSER','SERNUM','BUILD','XOVER','MODEL'):
+		if key in trace.header:
+			header[key] = trace.header[key]
+	return {'header':header,'date':trace.header['DATE'],
+		'netacr':float(trace.darray.netacr[-1]),
+		'discwh':float(trace.darray.discwh[-1]),
+		'wavg':float(trace.darray.wavg[-1])}
+
+# Windows sorted per block in filter_data, to bound the temporary
+# block x size array
+FILTER_BLOCK = 65536
 
 def filter_data(series,size=5):
+	"""
+	Smooth series with a sliding window of size points, dropping the
+	lowest and highest value in each window and averaging the rest.
+	"""
 	if len(series) == 0:
 		return []
 
@@ -358,28 +578,130 @@ def filter_data(series,size=5):
 		size += 1
 
 	center = int(size/2)
-	filtered_data = []
-	filter_series = []
-	flist = series.tolist()
+	flist = np.asarray(series,dtype=float)
 
 	# Create the data series with the ends extended
 	# so we don't have to special case the fist and last
 	# point.  Repeating the beginning and end values help
 	# weight the start and end points more toward the real
 	# values.
-	for x in xrange(0,center):
-		filter_series.append(flist[0])
-	filter_series.extend(flist[:])
-	# One more item on the end so we don't thow an out
-	# of range index error.
-	for x in xrange(0,center+1):
-		filter_series.append(flist[-1])
-	end = len(filter_series)-center-1
-	for index in xrange(center,end):
-		chunk = sorted(filter_series[index-center:index+center+1])[1:-1]
-		filtered_data.append(np.average(chunk))
+	filter_series = np.concatenate((np.repeat(flist[:1],center),flist,np.repeat(flist[-1:],center)))
+
+	# Each row is a view of the window around one point.  Sorting the rows
+	# and averaging all but the ends gives the same sums as sorting each
+	# window in turn.
+	stride = filter_series.strides[0]
+	windows = np.lib.stride_tricks.as_strided(filter_series,
+		shape=(len(flist),size),strides=(stride,stride))
+	filtered_data = np.empty(len(flist))
+	for first in xrange(0,len(flist),FILTER_BLOCK):
+		chunk = np.sort(windows[first:first+FILTER_BLOCK],axis=1)[:,1:-1]
+		filtered_data[first:first+FILTER_BLOCK] = chunk.mean(axis=1)
 	return filtered_data
 
+def decimate(x,y,points):
+	"""
+	Min-max decimation: split the series into points/2 buckets and keep
+	the lowest and highest sample of each, plus the end points, in their
+	original order so the peaks survive.
+	"""
+	x = np.asarray(x)
+	y = np.asarray(y)
+	n = len(y)
+	buckets = points / 2
+	if buckets < 1 or n <= points:
+		return (x,y)
+	size = -(-n / buckets)
+	full = n / size * size
+	starts = np.arange(0,full,size)
+	rows = y[:full].reshape(-1,size)
+	keep = [starts + rows.argmin(axis=1),starts + rows.argmax(axis=1),np.array([0,n-1])]
+	if full < n:
+		keep.append(np.array([full + y[full:].argmin(),full + y[full:].argmax()]))
+	keep = np.unique(np.concatenate(keep))
+	return (x[keep],y[keep])
+
+def plot_series(ax,x,y,points=None):
+	"""
+	ax.plot(x,y), decimated to about points points first if points is
+	set.  0 means two points per pixel of the axis width.
+	"""
+	if points is not None:
+		if points == 0:
+			points = int(2 * ax.bbox.width)
+		(x,y) = decimate(x,y,points)
+	return ax.plot(x,y)
+
+# The PwrLogfile and filters each pool worker reads with
+worker_setup = None
+
+def init_worker(pl,filters,summarizer=None):
+	global worker_setup
+	worker_setup = (pl,filters,summarizer)
+
+def read_trace(filename):
+	"""Pool worker: read one file with the parent's PwrLogfile settings"""
+	(pl,filters,summarizer) = worker_setup
+	trace = pl.read_file(filename,**filters)
+	if summarizer and trace.valid:
+		trace.summary = summarizer.summarize(filename,pl.index)
+	return trace
+
+def read_traces(pl,filenames,filters,jobs=1,summarizer=None):
+	"""
+	Generate a pwr_trace for each file, in filenames order.  With more
+	than one job the files are parsed by a pool of worker processes and
+	the results handed back as they come in.  With a summarizer each
+	valid trace also gets the file's LogSummary.
+	"""
+	if jobs <= 1:
+		init_worker(pl,filters,summarizer)
+		for filename in filenames:
+			yield read_trace(filename)
+		return
+
+	pool = multiprocessing.Pool(jobs,init_worker,(pl,filters,summarizer))
+	for trace in pool.imap(read_trace,filenames):
+		yield trace
+	pool.close()
+	pool.join()
+
+def render_figure(job):
+	"""
+	Pool worker: save one pickled figure as DIR/<label>/<label>.<fmt>
+	for each format.  Returns the files written.
+	"""
+	(data,outdir,formats) = job
+	fig = cPickle.loads(data)
+	name = fig.get_label()
+	figdir = os.path.join(outdir,name)
+	if not os.path.isdir(figdir):
+		os.makedirs(figdir)
+	written = []
+	for fmt in formats:
+		path = os.path.join(figdir,'%s.%s' % (name,fmt))
+		fig.savefig(path)
+		written.append(path)
+	return written
+
+def render_figures(outdir,formats,jobs=1):
+	"""
+	Write every open figure to its own directory under outdir, jobs
+	figures at a time.
+	"""
+	figures = [ plt.figure(num) for num in plt.get_fignums() ]
+	jobs_list = [ (cPickle.dumps(fig,2),outdir,formats) for fig in figures ]
+	if jobs <= 1:
+		results = map(render_figure,jobs_list)
+	else:
+		pool = multiprocessing.Pool(jobs)
+		results = pool.map(render_figure,jobs_list)
+		pool.close()
+		pool.join()
+	for written in results:
+		for path in written:
+			print path
+
 def process_logs(filenames,opt):
 	# scatter plots need lists of numbers
 
@@ -408,6 +730,8 @@ def process_logs(filenames,opt):
 	xover_list		= []
 	model_list		= []
 	trim			= opt.trim
+	filter_window		= opt.filter_window
+	decimate_points		= opt.decimate
 	discwh_filter		= False
 	show_dischist		= opt.dischist
 
@@ -453,12 +777,25 @@ def process_logs(filenames,opt):
 	acr_trend_avg = []
 
 	pl.set_min_sample_interval(opt.compress)
+	trend_store = None
+	if opt.trendstore:
+		trend_store = olpcpwrlog.TrendStore(opt.trendstore,pl.cache_params())
+	if opt.cache:
+		pl.set_cache(olpcpwrlog.ParseCache(opt.cachedir,opt.cachesize))
+	if opt.index:
+		# Bring the index up to date here so the pool workers all
+		# start from the same copy.
+		pl.set_index(olpcpwrlog.HeaderIndex())
+		for filename in filenames:
+			pl.index.entry(filename)
+		pl.index.save()
 
 	if save_graphs:
 		pp = PdfPages('graphs.pdf')
 
 	if show_avgpwr:
 		fig = figure()
+		fig.set_label('avgpwr')
 		ax = fig.add_subplot(111)
 		ax.set_title('Avg Power vs Time' )
 		figures.append(fig)
@@ -466,6 +803,7 @@ def process_logs(filenames,opt):
 # Bat current vs SOC.
 	if dont_show:
 		fig2 = figure()
+		fig2.set_label('cur-soc')
 		ax2 = fig2.add_subplot(111)
 		figures.append(fig2)
 
@@ -473,6 +811,7 @@ def process_logs(filenames,opt):
 		if not opt.voltcur:
 			show_voltcur = 0
 		fig3 = figure()
+		fig3.set_label('power')
 		ax3 = fig3.add_subplot(111)
 		ax3.set_xlabel('Delta Time (Hours)')
 		ax3.set_ylabel('Inst Power (Watts)')
@@ -498,6 +837,7 @@ def process_logs(filenames,opt):
 		if not opt.voltcur:
 			show_voltcur = 0
 		fig9=figure()
+		fig9.set_label('current')
 		ax9 = fig9.add_subplot(111)
 		if show_raw_data:
 		    title = 'Current vs Time'
@@ -513,6 +853,7 @@ def process_logs(filenames,opt):
 
 	if show_todpwr:
 		fig5 = figure()
+		fig5.set_label('tod-power')
 		ax5 = fig5.add_subplot(111)
 		ax5.set_xlabel('Time of Day (H.M/60)')
 		ax5.set_ylabel('Inst Power (Watts)')
@@ -521,17 +862,20 @@ def process_logs(filenames,opt):
 
 	if show_volt:
 		fig6 = figure()
+		fig6.set_label('voltage')
 		ax6 = fig6.add_subplot(111)
 		ax6.set_title('Voltage vs Time' )
 		figures.append(fig6)
 	if show_zavg:
 		fig7 = figure()
+		fig7.set_label('impedance')
 		ax7 = fig7.add_subplot(111)
 		ax7.set_title('Impeadance vs Time' )
 		figures.append(fig7)
 
 	if show_acrhist:
 		fig8= figure()
+		fig8.set_label('acr-hist')
 		ax8 = fig8.add_subplot(111)
 		if title_append:
 		    ax8.set_title('Capacity Histogram (%s)' % title_append)
@@ -549,6 +893,7 @@ def process_logs(filenames,opt):
 
 	if show_wavg_vs_acr:
 		fig10=figure()
+		fig10.set_label('wavg-acr')
 		ax10 = fig10.add_subplot(111)
 		ax10.set_title('Average Wattage vs Net Acr')
 		ax10.set_ylabel('Net ACR')
@@ -558,6 +903,7 @@ def process_logs(filenames,opt):
 
 	if show_temp:
 		fig11 = figure()
+		fig11.set_label('temp')
 		ax11 = fig11.add_subplot(111)
 		ax11.set_title('Battery Temperature vs Time' )
 		ax11.set_ylabel('Battery Temperature degC')
@@ -567,6 +913,7 @@ def process_logs(filenames,opt):
 		if not opt.voltcur:
 			show_voltcur = 0
 		fig13 = figure()
+		fig13.set_label('discwh-hist')
 		ax13  = fig13.add_subplot(111)
 		if title_append:
 		    ax13.set_title('Discharge Wh Histogram\n%s' % title_append)
@@ -581,6 +928,7 @@ def process_logs(filenames,opt):
 
 	if show_acr_trend:
 		fig12 = figure()
+		fig12.set_label('acr-trend')
 		ax12 = fig12.add_subplot(111)
 		ax12.set_title('Per Battery net ACR Trend ' )
 		ax12.set_ylabel('Net ACR (mAh)')
@@ -597,6 +945,7 @@ def process_logs(filenames,opt):
 	# so this needs to be last
 	if show_voltcur:
 		fig4 = figure()
+		fig4.set_label('volt-cur')
 		ax4 = fig4.add_subplot(211)
 		ax4.grid()
 		title = 'Voltage vs Time'
@@ -614,84 +963,131 @@ def process_logs(filenames,opt):
 		ax4_2.set_ylabel('mA')
 		figures.append(fig4)
 
-	for filename in filenames:
-		read_result = pl.read_file(filename,builds=build_list,serials=serial_numbers,xovers=xover_list,models=model_list)
+	filters = {'builds':build_list,'serials':serial_numbers,'xovers':xover_list,'models':model_list}
+
+	# When the ACR trend is all there is to plot, logs already in the
+	# trend store are not read again.  The rest are read unfiltered so
+	# the store gets every log and the filters are applied to the runs.
+	trend_only = trend_store is not None and show_acr_trend and not (show_avgpwr or
+		show_instpwr or show_voltcur or dont_show or show_todpwr or show_volt or
+		show_zavg or show_cur or show_wavg_vs_acr or show_temp or show_acrhist or show_dischist)
+	if trend_only:
+		read_names = [ f for f in filenames if trend_store.run(f) is None ]
+		read_filters = {}
+	else:
+		read_names = filenames
+		read_filters = filters
+
+	table = None
+	summarizer = None
+	if opt.table and not trend_only:
+		table = olpcpwrlog.SummaryTable(opt.table)
+		summarizer = olpcpwrlog.LogSummarizer()
+
+	for trace in read_traces(pl,read_names,read_filters,opt.jobs,summarizer):
+
+		if trend_store is not None and (trend_only or trace.valid):
+			trend_store.update(trace.filename,trend_run(trace))
+		if trend_only:
+			continue
 
 		if debug_show_filenames:
-			print filename
-			if not read_result:
+			print trace.filename
+			if not trace.valid:
 				print "Skipped"
 
-		if not read_result:
+		if not trace.valid:
 			continue
 
-		if opt.nochg and pl.darray.wavg[-1] > 0:
+		if opt.nochg and trace.darray.wavg[-1] > 0:
 			continue
 
-		if discwh_filter and pl.darray.discwh[-1] > discwh_value:
+		if discwh_filter and trace.darray.discwh[-1] > discwh_value:
 			continue
 
-		end = len(pl.darray.watts)-trim
+		if table and trace.summary.readable:
+			table.write(trace.summary.values())
+
+		end = len(trace.darray.watts)-trim
 
 		if show_avgpwr:
-			ax.plot(pl.darray.th[SKIP:end],pl.darray.wavg[SKIP:end])
+			plot_series(ax,trace.darray.th[SKIP:end],trace.darray.wavg[SKIP:end],decimate_points)
 
 		if show_instpwr:
 			if show_raw_data:
-				ax3.plot(pl.darray.th[SKIP:end],pl.darray.watts[SKIP:end])
+				plot_series(ax3,trace.darray.th[SKIP:end],trace.darray.watts[SKIP:end],decimate_points)
 			else:
-				mavg = filter_data(pl.darray.watts[SKIP:end])
-				ax3.plot(pl.darray.th[SKIP:end],mavg)
+				mavg = filter_data(trace.darray.watts[SKIP:end],filter_window)
+				plot_series(ax3,trace.darray.th[SKIP:end],mavg,decimate_points)
 		if show_voltcur:
-			ax4.plot(pl.darray.th[SKIP:end],pl.darray.vb[SKIP:end])
-			ax4_2.plot(pl.darray.th[SKIP:end],pl.darray.ib[SKIP:end])
+			plot_series(ax4,trace.darray.th[SKIP:end],trace.darray.vb[SKIP:end],decimate_points)
+			plot_series(ax4_2,trace.darray.th[SKIP:end],trace.darray.ib[SKIP:end],decimate_points)
 
 		if dont_show:
-			ax2.plot(pl.darray.soc[SKIP:end],pl.darray.ib[SKIP:end])
+			plot_series(ax2,trace.darray.soc[SKIP:end],trace.darray.ib[SKIP:end],decimate_points)
 
 		if show_todpwr:
-			ax5.plot(pl.darray.tod[SKIP:end],pl.darray.watts[SKIP:end])
+			plot_series(ax5,trace.darray.tod[SKIP:end],trace.darray.watts[SKIP:end],decimate_points)
 
 		if show_volt:
-			ax6.plot(pl.darray.th[SKIP:end],pl.darray.vb[SKIP:end])
+			plot_series(ax6,trace.darray.th[SKIP:end],trace.darray.vb[SKIP:end],decimate_points)
 		if show_zavg:
-			ax7.plot(pl.darray.th[SKIP:end],pl.darray.zavg[SKIP:end])
+			plot_series(ax7,trace.darray.th[SKIP:end],trace.darray.zavg[SKIP:end],decimate_points)
 		if show_cur:
 			if show_raw_data:
-				ax9.plot(pl.darray.th[SKIP:end],pl.darray.ib[SKIP:end])
+				plot_series(ax9,trace.darray.th[SKIP:end],trace.darray.ib[SKIP:end],decimate_points)
 			else:
-				mavg = filter_data(pl.darray.ib[SKIP:end],5)
-				ax9.plot(pl.darray.th[SKIP:end],mavg)
+				mavg = filter_data(trace.darray.ib[SKIP:end],filter_window)
+				plot_series(ax9,trace.darray.th[SKIP:end],mavg,decimate_points)
 
 		if show_wavg_vs_acr:
-			ax10.scatter(abs(pl.darray.wavg[-1]),abs(pl.darray.netacr[-1]))
+			ax10.scatter(abs(trace.darray.wavg[-1]),abs(trace.darray.netacr[-1]))
 
 		if show_temp:
-			ax11.plot(pl.darray.th[SKIP:end],pl.darray.tb[SKIP:end])
+			plot_series(ax11,trace.darray.th[SKIP:end],trace.darray.tb[SKIP:end],decimate_points)
 
 		if show_acr_trend:
 			use_this_point = True
-			if ignore_date_before and pl.header['DATE'] < ignore_date:
+			if ignore_date_before and trace.header['DATE'] < ignore_date:
 				use_this_point = False
 
 			if use_this_point:
-				batser = pl.header['BATSER']
+				batser = trace.header['BATSER']
 				if batser in acr_trend:
 					 point_list = acr_trend[batser]
 				else:
 					point_list = []
 
 				# List elemets are a tuple of (date,ACR)
-				point_list.append( (pl.header['DATE'],abs(pl.darray.netacr[-1])) )
+				point_list.append( (trace.header['DATE'],abs(trace.darray.netacr[-1])) )
 				acr_trend[batser] = point_list
 
-		runtimes.append(pl.darray.th[-1])
-		netacrs.append(pl.darray.netacr[-1])
-		whs.append(pl.darray.wh[-1]*-1)
-		wavgs.append(pl.darray.wavg[-1]*-1)
+		runtimes.append(trace.darray.th[-1])
+		netacrs.append(trace.darray.netacr[-1])
+		whs.append(trace.darray.wh[-1]*-1)
+		wavgs.append(trace.darray.wavg[-1]*-1)
 		# Don't add short files or files with zero Wh
-		if pl.darray.discwh[-1] < -.01:
-			discwh.append(pl.darray.discwh[-1]*-1)
+		if trace.darray.discwh[-1] < -.01:
+			discwh.append(trace.darray.discwh[-1]*-1)
+
+	if trend_only:
+		for filename in filenames:
+			run = trend_store.run(filename)
+			if not run or not pl.header_selected(run['header'],**filters):
+				continue
+			if opt.nochg and run['wavg'] > 0:
+				continue
+			if discwh_filter and run['discwh'] > discwh_value:
+				continue
+			if ignore_date_before and run['date'] < ignore_date:
+				continue
+			acr_trend.setdefault(run['header']['BATSER'],[]).append( (run['date'],abs(run['netacr'])) )
+
+	if trend_store is not None:
+		trend_store.save()
+
+	if table:
+		table.close()
 
 	if show_acrhist:
 		abs_acr = [abs(x) for x in netacrs]
@@ -720,7 +1116,7 @@ def process_logs(filenames,opt):
 	if show_acr_trend:
 		for k,v in acr_trend.iteritems():
 			# sort the tuples by date rundate
-			v.sort(acr_trend_compare)
+			v.sort(key=lambda x:x[0])
 			# Break the (date,value) tuple apart and replace the date with number starting at 1 continuing to the
 			# end of this list.  This make the plots regular on the X axis
 			item_index=0
@@ -760,7 +1156,10 @@ def process_logs(filenames,opt):
 			pp.savefig(each)
 		pp.close()
 
-	show()
+	if opt.outdir:
+		render_figures(opt.outdir,opt.format.split(','),opt.jobs)
+	else:
+		show()
 
 def main():
 
@@ -780,6 +1179,10 @@ def main():
 		help='Plot average wattage vs net ACR')
 	parser.add_argument('--raw', action='store_true',default=False,
 		help="Don't filter the data")
+	parser.add_argument('--filter-window', action='store',type=int,default=5,
+		help="Number of points, odd and at least 3, in the power and current filter")
+	parser.add_argument('--decimate', action='store',type=int,default=None,metavar='POINTS',
+		help="Plot each series as about POINTS min/max points.  0 uses two per pixel of plot width")
 	parser.add_argument('--avgpwr', action='store_true',default=False,
 		help="Output average power for all series")
 	parser.add_argument('--acrhist', action='store_true',default=False,
@@ -796,6 +1199,10 @@ def main():
 		help="Text to append to the plot titles")
 	parser.add_argument('--acrtrend', action='store_true',default=False,
 		help="Plot net ACR trend per battery")
+	parser.add_argument('--table', action='store',type=str,default=None,
+		help="Write the process-pwr_log summary of each plotted file to this typed csv table")
+	parser.add_argument('--trendstore', action='store',type=str,default=None,
+		help="Keep per log ACR trend results in this file.  When the ACR trend is the only plot (--acrtrend --novoltcur) logs already in it are not read again")
 	parser.add_argument('--dignore',
 		help="Ignore dates eariler than this for ACR trend")
 	parser.add_argument('--byxo', action='store_true',default=False,
@@ -820,9 +1227,30 @@ def main():
 		help='Minimum discharge Wh to show')
 	parser.add_argument('--dischist', action='store_true',default=False,
 		help="Histogram of discharge Wh")
+	parser.add_argument('--index', action='store_true',default=False,
+		help="Keep a header index in each log directory and use it to skip filtered out files")
+	parser.add_argument('--jobs', action='store',type=int,default=1,
+		help="Number of processes to read the log files and render the figures with")
+	parser.add_argument('--outdir', action='store',type=str,default=None,
+		help="Don't open a display, write each figure to its own directory under OUTDIR")
+	parser.add_argument('--format', action='store',type=str,default='png',
+		help="Formats to write with --outdir: png, svg or pdf.  Multiple formats can be in a quoted csv string")
+	parser.add_argument('--cache', action='store_true',default=False,
+		help="Keep parsed logs in an on disk cache so re-plotting skips the parsing")
+	parser.add_argument('--cachedir', action='store',type=str,default=olpcpwrlog.CACHE_DIR,
+		help="Directory for the parsed log cache")
+	parser.add_argument('--cachesize', action='store',type=int,default=olpcpwrlog.CACHE_SIZE,
+		help="Size limit in MB of the parsed log cache")
 
 	args = parser.parse_args()
 
+	if args.filter_window < 3 or not (args.filter_window % 2):
+		parser.error('--filter-window must be an odd number of at least 3')
+
+	if args.outdir:
+		# Headless: render with Agg, nothing needs a display
+		plt.switch_backend('Agg')
+
 	if len(args.filenames) != 0:
 	    process_logs(args.filenames,args)
 	else:
@@ -1,110 +1,348 @@
 #!/usr/bin/python
 
-import MySQLdb
-import MySQLdb.cursors
 import os.path
 import sys
 from datetime import datetime
 import argparse
+import multiprocessing
+import threading
+import Queue
 
 import olpcpwrlog
 import powerlogsdb
 
+# Some feilds are named differently in the database due to them
+# being keywords.
+fxlate = {}
+fxlate['COMMENT'] = 'log_comment'
+fxlate['Format']  = 'log_format'
+
+sample_fields = ["file_id","date_sec","soc","voltage","amperage","temp","acr","status","event","date_dtval"]
+
+# The process-pwr_log results that go in the summaries table.  The
+# header fields it also reports are already in files.
+summary_fields = [ name for (name,kind) in olpcpwrlog.SUMMARY_COLUMNS[7:] ]
+
+# Writer threads and the progress line share stdout
+output_lock = threading.Lock()
+
+def report(msg):
+	output_lock.acquire()
+	try:
+		print msg
+		sys.stdout.flush()
+	finally:
+		output_lock.release()
+
+class Checkpoint:
+	"""
+	List of files already imported.  Each file is appended as soon as
+	its transaction commits so an interrupted import can pick up where
+	it stopped.
+	"""
+	def __init__(self,filename=None):
+		self.lock = threading.Lock()
+		self.done = set()
+		self.fd = None
+		if filename:
+			if os.path.exists(filename):
+				for line in open(filename):
+					self.done.add(line.rstrip('\n'))
+			self.fd = open(filename,'a')
+
+	def completed(self,fname):
+		return os.path.abspath(fname) in self.done
+
+	def mark(self,fname):
+		if not self.fd:
+			return
+		self.lock.acquire()
+		try:
+			self.fd.write(os.path.abspath(fname) + '\n')
+			self.fd.flush()
+		finally:
+			self.lock.release()
+
+# The PwrLogfile and LogSummarizer each parse worker uses
+worker_pl = None
+worker_summarizer = None
+
+def init_worker(pl,summarizer=None):
+	global worker_pl, worker_summarizer
+	worker_pl = pl
+	worker_summarizer = summarizer
+
+def parse_log(fname):
+	"""
+	Parse one log ready for the database.  Returns (fname,fields,values,
+	key,samples,summary,error) where error is a message if the file is
+	to be skipped and summary is None unless summaries were asked for.
+	"""
+	pl = worker_pl
+	fields = []
+	values = []
+	try:
+		pl.parse_header(fname)
+	except:
+		return (fname,None,None,None,None,None,
+			"%s : Could not parse header. Error: %s" % (fname,sys.exc_info()[:2]))
+
+	samples,errors = pl.parse_records()
+	if len(errors):
+		msg = "%s : Skipping.  Line errors: " % fname
+		for e in errors:
+			msg += '\n%s' % (e,)
+		return (fname,None,None,None,None,None,msg)
+
+	# Create the entry in the file table from the headers
+	headers = pl.get_headers()
+	for (k,v) in headers.iteritems():
+		if k == 'DATE':
+			# DATE has time zone imfo which is not handled by the datetime field so skip log_date and log_tz have info
+			continue
+		if k in fxlate:
+			fields.append(fxlate[k])
+		else:
+			fields.append(k)
+		values.append(v)
+
+	key = (headers['date_string'],headers['SERNUM'],headers['BATSER'])
+
+	summary = None
+	if worker_summarizer:
+		log = worker_summarizer.summarize(fname)
+		if log.readable:
+			summary = log.values()
+	return (fname,fields,values,key,samples,summary,None)
+
+def parse_logs(pl,filenames,jobs=1,summarizer=None):
+	"""Generate parse_log results in filenames order using jobs processes"""
+	if jobs <= 1:
+		init_worker(pl,summarizer)
+		for fname in filenames:
+			yield parse_log(fname)
+		return
+
+	pool = multiprocessing.Pool(jobs,init_worker,(pl,summarizer))
+	for parsed in pool.imap(parse_log,filenames):
+		yield parsed
+	pool.close()
+	pool.join()
+
+def store_log(dbc,args,parsed):
+	"""Write one parsed log as a single transaction.  True if it went in."""
+	(fname,fields,values,key,samples,summary,error) = parsed
+	if error:
+		report(error)
+		return False
+
+	# if replace is active and we exist then we need to delete all this files
+	# records first
+	try:
+		# New columns go in first as adding one on SQLite commits
+		# whatever the transaction has done so far
+		dbc.add_columns('files',fields)
+		if summary:
+			dbc.add_columns('summaries',['file_id'] + summary_fields)
+		if args.replace:
+			# Find the file_id for the file and delete the samples
+			findcmd = "SELECT file_id from files WHERE"
+			findcmd += " date_string = %s AND sernum = %s AND batser = %s;"
+			dbc.do_query(findcmd,key)
+			row = dbc.get_row()
+			if row:
+				file_id = row[0]
+				dbc.do_query("DELETE from files WHERE file_id = %s",(file_id,))
+				dbc.do_query("DELETE from samples WHERE file_id = %s",(file_id,))
+				if args.summaries:
+					dbc.do_query("DELETE from summaries WHERE file_id = %s",(file_id,))
+
+		file_id = dbc.insert_row('files',fields,values)
+		if summary:
+			dbc.insert_row('summaries',['file_id'] + summary_fields,
+				[file_id] + [ summary[f] for f in summary_fields ])
+	except:
+		dbc.rollback()
+		report("%s: Could not create file entry. Error: %s" % (fname,sys.exc_info()[:2]))
+		return False
+
+	# Now insert all the sampels from the log file using
+	# the file_id just created.
+	rows = []
+	for sval in samples:
+		values = []
+		values.append(file_id)
+		values.append(int(sval[0]))
+		values.append(int(sval[1]))
+		values.extend(sval[2:])
+		rows.append(values)
+
+	try:
+		if args.load_data and len(rows) >= args.load_data:
+			dbc.load_rows('samples',sample_fields,rows)
+		else:
+			dbc.insert_rows('samples',sample_fields,rows)
+		dbc.commit()
+	except:
+		dbc.rollback()
+		report("%s: Could not insert samples. Error: %s" % (fname,sys.exc_info()[:2]))
+		return False
+	return True
+
+def db_writer(dbc,args,queue,checkpoint,failed):
+	"""
+	Writer thread: store parsed logs from queue on its own connection.
+	An error store_log does not handle, such as a rollback on a lost
+	connection or the checkpoint file failing, stops the writer and is
+	added to failed.
+	"""
+	while True:
+		parsed = queue.get()
+		if parsed is None:
+			break
+		try:
+			if store_log(dbc,args,parsed):
+				checkpoint.mark(parsed[0])
+		except:
+			report("%s: Database writer stopped. Error: %s" % (parsed[0],sys.exc_info()[:2]))
+			failed.append(parsed[0])
+			break
+
+def queue_put(queue,item,writers):
+	"""Put item on queue unless no writer is left to take it.  True if it went on."""
+	while True:
+		try:
+			queue.put(item,True,1)
+			return True
+		except Queue.Full:
+			if not [ w for w in writers if w.is_alive() ]:
+				return False
+
+def file_key(filename,index=None):
+	"""
+	The (date_string,sernum,batser) key of a log from its header alone,
+	or None if the header does not have them all.
+	"""
+	if index:
+		entry = index.entry(filename)
+	else:
+		entry = olpcpwrlog.scan_header(filename)
+	date_string = olpcpwrlog.header_date_string(entry['lines'])
+	fields = entry['fields']
+	if date_string is None or 'SERNUM' not in fields or 'BATSER' not in fields:
+		return None
+	return (date_string,fields['SERNUM'],fields['BATSER'])
+
+def new_conn(args):
+	"""Open a connection to the database the import goes to"""
+	if args.sqlite:
+		dbc = powerlogsdb.sqlite_conn(args.sqlite,args.batch)
+	else:
+		dbc = powerlogsdb.db_conn(args.batch)
+	dbc.connect(local_infile=args.load_data > 0)
+	if args.summaries:
+		dbc.create_summaries(olpcpwrlog.SUMMARY_COLUMNS[7:])
+	return dbc
+
 def main():
 
 	parser = argparse.ArgumentParser(description='add pwrlogs to database')
 	parser.add_argument('filenames', nargs='+', help='files to process')
 	parser.add_argument('--replace', action='store_true',
                 help='Overwrite existing datafiles')
+	parser.add_argument('--cache', action='store_true',
+                help='Keep parsed logs in an on disk cache')
+	parser.add_argument('--cachedir', default=olpcpwrlog.CACHE_DIR,
+                help='Directory for the parsed log cache')
+	parser.add_argument('--cachesize', type=int, default=olpcpwrlog.CACHE_SIZE,
+                help='Size limit in MB of the parsed log cache')
+	parser.add_argument('--batch', type=int, default=1000,
+                help='Number of samples per INSERT statement')
+	parser.add_argument('--load-data', type=int, default=0, metavar='N',
+                help='Bulk load files with at least N samples using LOAD DATA LOCAL INFILE')
+	parser.add_argument('--jobs', type=int, default=1,
+                help='Number of processes parsing the log files')
+	parser.add_argument('--writers', type=int, default=1,
+                help='Number of database connections writing the logs')
+	parser.add_argument('--checkpoint', metavar='FILE',
+                help='Record imported files in FILE and skip the ones already listed there')
+	parser.add_argument('--sqlite', metavar='FILE',
+                help='Import into the SQLite database FILE instead of the MySQL server')
+	parser.add_argument('--index', action='store_true',
+                help='Keep a header index in each log directory to find already imported files')
+	parser.add_argument('--summaries', action='store_true',
+                help='Also store the process-pwr_log summary of each file in the summaries table')
 
 	args = parser.parse_args()
 
-	dbc = powerlogsdb.db_conn()
-	dbc.connect()
-
 	pl = olpcpwrlog.PwrLogfile()
+	if args.cache:
+		pl.set_cache(olpcpwrlog.ParseCache(args.cachedir,args.cachesize))
 
-	# Some feilds are named differently in the database due to them 
-	# being keywords.
-	fxlate = {}
-	fxlate['COMMENT'] = 'log_comment'
-	fxlate['Format']  = 'log_format'
+	checkpoint = Checkpoint(args.checkpoint)
+	filenames = [ f for f in args.filenames if not checkpoint.completed(f) ]
+	if len(filenames) != len(args.filenames):
+		print "Resuming: %d of %d files already imported" % (len(args.filenames) - len(filenames),len(args.filenames))
 
-	numfiles = len(args.filenames)
+	# Without --replace files already in the database are skipped before
+	# they are parsed.  One query up front gets all their keys.
+	if not args.replace:
+		dbc = new_conn(args)
+		dbc.do_query("SELECT date_string, sernum, batser FROM files;")
+		imported = set(dbc.get_rows())
+		index = None
+		if args.index:
+			index = olpcpwrlog.HeaderIndex()
+		new_files = []
+		for fname in filenames:
+			try:
+				key = file_key(fname,index)
+			except (OSError,IOError):
+				key = None
+			if key is not None and key in imported:
+				continue
+			if key is not None:
+				imported.add(key)
+			new_files.append(fname)
+		if index:
+			index.save()
+		if len(new_files) != len(filenames):
+			print "Skipping %d files already in the database" % (len(filenames) - len(new_files))
+		filenames = new_files
+
+	# Keep the parsers only a little ahead of the writers
+	queue = Queue.Queue(2 * max(args.writers,1))
+	writers = []
+	failed = []
+	for n in xrange(max(args.writers,1)):
+		dbc = new_conn(args)
+		w = threading.Thread(target=db_writer,args=(dbc,args,queue,checkpoint,failed))
+		w.daemon = True
+		w.start()
+		writers.append(w)
+
+	numfiles = len(filenames)
 	filenum = 0
-	for fname in args.filenames:
+	summarizer = None
+	if args.summaries:
+		summarizer = olpcpwrlog.LogSummarizer()
+
+	for parsed in parse_logs(pl,filenames,args.jobs,summarizer):
 		filenum+=1
+		output_lock.acquire()
 		print "%d of %d\r" % (filenum,numfiles),
 		sys.stdout.flush()
-		fields = []
-		values = []
-		try:
-			pl.parse_header(fname)
-		except:
-			print "%s : Could not parse header. Error: " % fname,
-			print sys.exc_info()
-			continue
-	
-		samples,errors = pl.parse_records()
-		if len(errors):
-			print "%s : Skipping.  Line errors: " % fname
-			for e in errors:
-				print e
-			continue
-
-		# Create the entry in the file table from the headers
-		headers = pl.get_headers()
-		for (k,v) in headers.iteritems():
-			if k == 'DATE':
-				# DATE has time zone imfo which is not handled by the datetime field so skip log_date and log_tz have info 
-				continue
-			if k in fxlate:
-				fields.append(fxlate[k])
-			else:
-				fields.append(k)
-			values.append(v) 
-		
-		# if replace is active and we exist then we need to delete all this files
-		# records first
-		findcmd = "SELECT file_id from files WHERE"
-		findcmd += " date_string = '%s'" % headers['date_string'] 
-		findcmd += " AND sernum = '%s'" % headers['SERNUM']
-		findcmd += " AND batser = '%s'" % headers['BATSER']
-		findcmd += ';'
+		output_lock.release()
+		if not queue_put(queue,parsed,writers):
+			report("All database writers have stopped.  Giving up.")
+			sys.exit(1)
 
-		if args.replace:
-			# Find the file_id for the file and delete the samples
-			dbc.do_query(findcmd)
-			row = dbc.get_row()
-			if row: 
-				file_id = row[0]
-				cmd = "DELETE from files WHERE file_id = '%s'" % file_id
-				dbc.do_query(cmd)
-				cmd = "DELETE from samples WHERE file_id = '%s'" % file_id
-				dbc.do_query(cmd)
-
-		try:	
-			dbc.insert_row('files',fields,values)
-		except:
-			print "%s: Could not create file entry. Error: " % fname,
-			print sys.exc_info()
-			continue
-	
-		dbc.do_query(findcmd)
-		file_id = dbc.get_row()[0]
-
-		# Now insert all the sampels from the log file using 
-		# the file_id just created.
-		
-		fields = ["file_id","date_sec","soc","voltage","amperage","temp","acr","status","event","date_dtval"]
-			 
-		for sval in samples:
-			values = []
-			values.append(file_id) 
-			values.append(int(sval[0]))
-			values.append(int(sval[1]))
-			values.extend(sval[2:])
-			dbc.insert_row('samples',fields,values)
+	for w in writers:
+		queue_put(queue,None,writers)
+	for w in writers:
+		w.join()
+	if failed:
+		sys.exit(1)
 
 
 main()
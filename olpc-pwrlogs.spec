@@ -27,6 +27,8 @@ rm -rf $RPM_BUILD_ROOT
 %{__install} -D -m 0755 rtcwake-log		$RPM_BUILD_ROOT/usr/bin/rtcwake-log
 %{__install} -D -m 0755 rtcwake-screen-log	$RPM_BUILD_ROOT/usr/bin/rtcwake-screen-log
 %{__install} -D -m 0755 process-pwr_log.py	$RPM_BUILD_ROOT/usr/bin/process-pwr_log.py
+%{__install} -D -m 0755 compact-pwrlog.py	$RPM_BUILD_ROOT/usr/bin/compact-pwrlog.py
+%{__install} -D -m 0644 olpcpwrlog.py		$RPM_BUILD_ROOT%{python_sitelib}/olpcpwrlog.py
 
 
 %clean
@@ -40,6 +42,8 @@ rm -rf $RPM_BUILD_ROOT
 /usr/bin/rtcwake-log
 /usr/bin/rtcwake-screen-log
 /usr/bin/process-pwr_log.py
+/usr/bin/compact-pwrlog.py
+%{python_sitelib}/olpcpwrlog.py*
 
 %changelog
 
@@ -1,45 +1,193 @@
-import MySQLdb
-import MySQLdb.cursors
+try:
+        import MySQLdb
+        import MySQLdb.cursors
+except ImportError:
+        # Only needed for the MySQL backend
+        MySQLdb = None
+import sqlite3
 import os.path
 import sys
+import tempfile
+import threading
 from datetime import datetime
 
+def db_value(value):
+        """Turn a value from the log parsers into something the driver can bind"""
+        if isinstance(value,datetime) and value.tzinfo is not None:
+                # The DATETIME columns hold the naive time
+                return value.replace(tzinfo=None)
+        return value
+
+def infile_value(value):
+        """Format a value for a LOAD DATA tab separated file"""
+        if value is None:
+                return '\\N'
+        value = db_value(value)
+        if isinstance(value,float):
+                return '%f' % value
+        value = str(value)
+        return value.replace('\\','\\\\').replace('\t','\\t').replace('\n','\\n')
+
+# MySQL column type of each olpcpwrlog table column type
+mysql_types = {'str':'VARCHAR(255)','float':'DOUBLE','int':'INT'}
+
 class db_conn:
+        """Connection to the powerlogs database on the local MySQL server"""
+
+        # How the driver marks a bound value
+        placeholder = '%s'
 
-        def __init__(self):
+        def __init__(self,batch_size=1000):
+                if MySQLdb is None:
+                        raise ImportError('MySQLdb is needed for the MySQL backend')
                 assert MySQLdb.paramstyle == 'format'
+                # Rows per INSERT statement for insert_rows
+                self.batch_size = batch_size
 
-        def connect(self):
-                self.db = MySQLdb.connect(host='localhost',user='root', db='powerlogs')
+        def connect(self,local_infile=False):
+                if local_infile:
+                        self.db = MySQLdb.connect(host='localhost',user='root', db='powerlogs', local_infile=1)
+                else:
+                        self.db = MySQLdb.connect(host='localhost',user='root', db='powerlogs')
                 self.c = self.db.cursor()
 
+        def create_summaries(self,columns):
+                """
+                Create the summaries table if the database does not have it.
+                columns are the (name,type) pairs of olpcpwrlog.SUMMARY_COLUMNS
+                that it stores.
+                """
+                defs = [ '%s %s' % (name,mysql_types[kind]) for (name,kind) in columns ]
+                self.c.execute('CREATE TABLE IF NOT EXISTS summaries (file_id INT NOT NULL PRIMARY KEY, %s);' % ', '.join(defs))
+
+        def add_columns(self,table,fields):
+                """The MySQL tables are created with all their columns"""
+                pass
+
         def insert_row(self,table,fields,values):
-                cmd = 'INSERT INTO %s ' % table
-                field_fmt = '('
-                for each in fields:
-                        field_fmt += '%s,' % each
-                field_fmt = field_fmt[:-1] + ') '
-                value_fmt = 'VALUES ('
-                for each in values:
-                        if isinstance(each,int):
-                                value_fmt += '%d,' % each
-                        elif isinstance(each,long):
-                                value_fmt += '%d,' % each
-                        elif isinstance(each,str):
-                                value_fmt += "'%s'," % each
-                        elif isinstance(each,float):
-                                value_fmt += '%f,' % each
-                        elif isinstance(each,datetime):
-                                value_fmt += "'%s'," % str(each)[:-6]
-                        else:
-                                print "unknown type %s of %s" % (type(each),repr(each))
-
-                value_fmt = value_fmt[:-1] + ')'
-                cmd += field_fmt + value_fmt + ';'
-                self.c.execute(cmd)
-
-        def do_query(self,sql):
-                self.c.execute(sql)
+                """Insert one row and return its AUTO_INCREMENT id"""
+                cmd = 'INSERT INTO %s (%s) VALUES (%s);' % (table,','.join(fields),','.join([self.placeholder] * len(fields)))
+                self.c.execute(cmd,[db_value(x) for x in values])
+                return self.c.lastrowid
+
+        def insert_rows(self,table,fields,rows):
+                """
+                Insert many rows with the same fields.  The driver folds each
+                batch of batch_size rows into one multi row INSERT.
+                """
+                cmd = 'INSERT INTO %s (%s) VALUES (%s)' % (table,','.join(fields),','.join([self.placeholder] * len(fields)))
+                for start in xrange(0,len(rows),self.batch_size):
+                        batch = [ [db_value(x) for x in row] for row in rows[start:start+self.batch_size] ]
+                        self.c.executemany(cmd,batch)
+
+        def load_rows(self,table,fields,rows):
+                """
+                Bulk load rows through LOAD DATA LOCAL INFILE.  Much quicker
+                than INSERTs for big files but needs connect(local_infile=True)
+                and local_infile enabled on the server.
+                """
+                (fd,name) = tempfile.mkstemp(suffix='.tsv')
+                try:
+                        out = os.fdopen(fd,'w')
+                        for row in rows:
+                                out.write('\t'.join([infile_value(x) for x in row]))
+                                out.write('\n')
+                        out.close()
+                        cmd = "LOAD DATA LOCAL INFILE %%s INTO TABLE %s FIELDS TERMINATED BY '\\t' LINES TERMINATED BY '\\n' (%s);" % (table,','.join(fields))
+                        self.c.execute(cmd,(name,))
+                finally:
+                        os.remove(name)
+
+        def commit(self):
+                self.db.commit()
+
+        def rollback(self):
+                self.db.rollback()
+
+        def do_query(self,sql,params=None):
+                self.c.execute(sql,params)
 
         def get_row(self):
                 return self.c.fetchone()
+
+        def get_rows(self):
+                return self.c.fetchall()
+
+# Columns sqlite_conn creates up front.  The rest of the files columns
+# are header fields, and the summaries columns whatever the summarizer
+# reports, so they get added the first time a log has them.
+sqlite_schema = [
+        "CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY AUTOINCREMENT, date_string TEXT, sernum TEXT, batser TEXT);",
+        "CREATE TABLE IF NOT EXISTS samples (file_id INTEGER, date_sec INTEGER, soc INTEGER, voltage REAL, amperage REAL, temp REAL, acr REAL, status TEXT, event TEXT, date_dtval TEXT);",
+        "CREATE TABLE IF NOT EXISTS summaries (file_id INTEGER PRIMARY KEY);",
+        "CREATE INDEX IF NOT EXISTS files_key ON files (date_string, sernum, batser);",
+        "CREATE INDEX IF NOT EXISTS samples_file ON samples (file_id, date_sec);",
+        ]
+
+class sqlite_conn(db_conn):
+        """
+        The same interface on an embedded SQLite database file, so logs can
+        be imported and queried without a database server.  Queries are
+        written with %s placeholders as for MySQL.
+        """
+
+        placeholder = '?'
+
+        # Writer threads adding columns to the same table at the same time
+        schema_lock = threading.Lock()
+
+        def __init__(self,filename,batch_size=1000):
+                self.filename = filename
+                self.batch_size = batch_size
+                # Known columns of each table add_columns has seen
+                self.columns = {}
+
+        def connect(self,local_infile=False):
+                # Connections are made in one thread and used from another
+                self.db = sqlite3.connect(self.filename,timeout=60,check_same_thread=False)
+                self.c = self.db.cursor()
+                self.c.execute("PRAGMA journal_mode=WAL;")
+                self.c.execute("PRAGMA synchronous=NORMAL;")
+                for cmd in sqlite_schema:
+                        self.c.execute(cmd)
+                self.db.commit()
+
+        def add_columns(self,table,fields):
+                """
+                Add any of fields that table does not have yet.  The ALTER
+                TABLE commits any open transaction, so this has to be called
+                before the statements of a transaction, not in the middle.
+                """
+                if table in self.columns and set([f.lower() for f in fields]) <= self.columns[table]:
+                        return
+                self.schema_lock.acquire()
+                try:
+                        self.c.execute("PRAGMA table_info(%s);" % table)
+                        columns = set([row[1].lower() for row in self.c.fetchall()])
+                        for field in fields:
+                                if field.lower() not in columns:
+                                        self.c.execute('ALTER TABLE %s ADD COLUMN "%s";' % (table,field.replace('"','""')))
+                                        columns.add(field.lower())
+                        self.columns[table] = columns
+                finally:
+                        self.schema_lock.release()
+
+        def create_summaries(self,columns):
+                # In sqlite_schema already, add_columns adds the rest
+                pass
+
+        def insert_row(self,table,fields,values):
+                if table != 'samples':
+                        self.add_columns(table,fields)
+                return db_conn.insert_row(self,table,fields,values)
+
+        def load_rows(self,table,fields,rows):
+                # SQLite has no LOAD DATA and executemany is already its fast path
+                self.insert_rows(table,fields,rows)
+
+        def do_query(self,sql,params=None):
+                sql = sql.replace('%s','?')
+                if params is None:
+                        self.c.execute(sql)
+                else:
+                        self.c.execute(sql,params)